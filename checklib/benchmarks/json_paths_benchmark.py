@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares extracting a few key paths from multi-megabyte stats documents against decoding them with json.loads."""
+
+import json
+import sys
+import timeit
+from StringIO import StringIO
+from collections import OrderedDict
+
+from greplin.nagios import extractJsonPaths
+
+
+def histograms(count):
+  """Builds a large subtree of nested values, none of which are wanted."""
+  return dict(('histogram%d' % i, {'buckets': [[j * 0.5, j * 17] for j in xrange(20)],
+                                    'labels': {'name': 'endpoint "%d"' % i, 'path': '/api/v1/items/%d' % i}})
+              for i in xrange(count))
+
+
+def documents():
+  """Yields (label, document text, wanted paths) for each benchmarked document shape."""
+  yield ('large subtree first', json.dumps(OrderedDict([('histograms', histograms(12000)),
+                                                        ('queues', {'ingest': {'depth': 42}})])),
+         [('queues', 'ingest', 'depth')])
+  yield ('100k keys', json.dumps(OrderedDict([('stats', OrderedDict(('key%d' % i, i) for i in xrange(100000))),
+                                              ('uptime', 12345)])),
+         [('stats', 'key99999'), ('uptime',)])
+  yield ('wanted key first', json.dumps(OrderedDict([('uptime', 12345), ('histograms', histograms(12000))])),
+         [('uptime',)])
+
+
+def main():
+  """Run the benchmark."""
+  for label, text, paths in documents():
+    found = extractJsonPaths(StringIO(text), paths)
+    assert len(found) == len(paths), found
+    runs = 3
+    for name, fn in (('json.loads', lambda: json.loads(text)),
+                     ('extractJsonPaths', lambda: extractJsonPaths(StringIO(text), paths))):
+      seconds = min(timeit.repeat(fn, number=runs, repeat=3)) / runs
+      sys.stdout.write('%-20s %4.1fMB, %-18s %8.1f ms/document\n' % (
+          label + ':', len(text) / 1e6, name + ':', seconds * 1e3))
+
+
+if __name__ == '__main__':
+  main()
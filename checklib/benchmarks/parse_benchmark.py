@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures greplin.nagios.parseResponse throughput on large perf data lines."""
+
+import sys
+import timeit
+from cStringIO import StringIO
+
+from greplin.nagios import Maximum, ResponseBuilder, outputTo, parseResponse
+
+
+def buildOutput(items):
+  """Builds check output with the given number of perf data items."""
+  builder = ResponseBuilder()
+  for i in xrange(items):
+    if i % 2:
+      builder.addRule("stat '%d' latency" % i, Maximum(100, 200), i * 0.5)
+    else:
+      builder.addValue('stat.%d.count' % i, i)
+  with outputTo(StringIO()) as out:
+    try:
+      builder.finish()
+    except SystemExit:
+      pass
+    return out.getvalue()
+
+
+def main():
+  """Run the benchmark."""
+  for items in (10, 100, 1000, 10000):
+    text = buildOutput(items)
+    assert len(parseResponse(text).perfdata) == items
+    runs = max(1, 100000 // items)
+    seconds = min(timeit.repeat(lambda: parseResponse(text), number=runs, repeat=3)) / runs
+    sys.stdout.write('%6d items, %8d bytes: %10.1f us/parse, %10.0f items/s, %6.1f MB/s\n' % (
+        items, len(text), seconds * 1e6, items / seconds, len(text) / seconds / 1e6))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares extracting stats with a compiled Selector against repeated lookup calls."""
+
+import sys
+import timeit
+
+from greplin.nagios import Maximum, ResponseBuilder, Selector, lookup
+
+
+FIELDS = ('latency', 'count', 'errors')
+
+
+def buildStats(endpoints):
+  """Builds a stats document with the given number of endpoints."""
+  return {
+    'server': {'uptime': 12345, 'heap': {'used': 1 << 30, 'max': 1 << 32}},
+    'stats': dict(('endpoint%d' % i, {'latency': i * 0.25, 'count': i * 100, 'errors': i % 7})
+                  for i in xrange(endpoints))
+  }
+
+
+def withLookup(data, rule):
+  """Adds every stat with one lookup per value, the way checks do today."""
+  builder = ResponseBuilder()
+  builder.addStatLookup('uptime', data, 'server', 'uptime')
+  builder.addStatLookup('heap used', data, 'server', 'heap', 'used')
+  for endpoint in sorted(lookup(data, 'stats')):
+    builder.addRule('%s latency' % endpoint, rule, lookup(data, 'stats', endpoint, 'latency'))
+    builder.addStatLookup('%s count' % endpoint, data, 'stats', endpoint, 'count')
+    builder.addStatLookup('%s errors' % endpoint, data, 'stats', endpoint, 'errors')
+  return builder
+
+
+def withSelector(data, rule, selector, latency):
+  """Adds every stat with compiled selectors."""
+  builder = ResponseBuilder()
+  builder.addSelected(selector, data)
+  builder.addSelected(latency, data, rule)
+  return builder
+
+
+def main():
+  """Run the benchmark."""
+  rule = Maximum(100, 200)
+  selector = Selector([('uptime', 'server.uptime'), ('heap used', 'server.heap.used'),
+                       ('%s count', 'stats.*.count'), ('%s errors', 'stats.*.errors')])
+  latency = Selector([('%s latency', 'stats.*.latency')])
+
+  for endpoints in (10, 100, 1000):
+    data = buildStats(endpoints)
+    assert len(withLookup(data, rule)._perfdata) == len(withSelector(data, rule, selector, latency)._perfdata)
+    runs = max(1, 10000 // endpoints)
+    for label, fn in (('lookup', lambda: [('%s %s' % (endpoint, field), lookup(data, 'stats', endpoint, field))
+                                          for endpoint in sorted(data['stats']) for field in FIELDS]),
+                      ('selector', lambda: selector.extract(data) + latency.extract(data)),
+                      ('lookup + builder', lambda: withLookup(data, rule)),
+                      ('selector + builder', lambda: withSelector(data, rule, selector, latency))):
+      seconds = min(timeit.repeat(fn, number=runs, repeat=3)) / runs
+      sys.stdout.write('%5d endpoints, %-20s %10.1f us/document, %10.0f values/s\n' % (
+          endpoints, label + ':', seconds * 1e6, endpoints * len(FIELDS) / seconds))
+
+
+if __name__ == '__main__':
+  main()
@@ -14,12 +14,24 @@
 
 """The Greplin monitoring package."""
 
+import atexit
+import fcntl
 import httplib
 import json
+import os
+import re
 import socket
 import sys
+import tempfile
 import time
 import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+  from eventlet.corolocal import local
+except ImportError:
+  from threading import local
 
 
 UNKNOWN = 3
@@ -32,36 +44,310 @@ OK = 0
 
 STATUS_NAME = ['OK', 'WARN', 'CRIT', 'UNKNOWN']
 
-# This is a thread-local variable so clients can override it per-thread.
-GLOBAL_CONFIG = threading.local()
+# This is a thread-local variable so clients can override it per-thread.  When eventlet is available it is local to
+# each green thread, which also makes it local to each real thread.
+GLOBAL_CONFIG = local()
 GLOBAL_CONFIG.outfile = sys.stdout
 
 
-def output(msg):
-  """Send output to output stream."""
-  GLOBAL_CONFIG.outfile.write(msg)
-  GLOBAL_CONFIG.outfile.write('\n')
+def output(msg, outfile = None):
+  """Send output to the given stream, or else this thread's output stream, or else stdout."""
+  outfile = outfile or getattr(GLOBAL_CONFIG, 'outfile', None) or sys.stdout
+  outfile.write(msg)
+  outfile.write('\n')
 
 
-def wgetWithTimeout(host, port, path, timeout, secure = False):
-  """Gets an http page, but times out if it's too slow."""
-  start = time.time()
+class CheckFailed(BaseException):
+  """Raised by helpers that can't continue, instead of exiting, while results are being collected.  Like SystemExit, it
+  is not an Exception, so checks that catch Exception behave as they do on the command line."""
+
+  def __init__(self, status, text):
+    BaseException.__init__(self, text)
+    self.status = status
+    self.text = text
+
+
+  def result(self):
+    """Returns the failure as a CheckOutput."""
+    result = parseResponse(self.text)
+    result.status = self.status
+    return result
+
+
+
+class CheckFinished(BaseException):
+  """Raised by ResponseBuilder.finish while results are being collected, to stop the check as exiting would.  Like
+  SystemExit, it is not an Exception, so checks that catch Exception don't swallow it."""
+
+
+
+def fail(status, text):
+  """Ends the check with the given status and output line: raises CheckFailed while results are being collected,
+  otherwise outputs the line and exits."""
+  if getattr(GLOBAL_CONFIG, 'results', None) is not None:
+    raise CheckFailed(status, text)
+  output(text)
+  exit(status)
+
+
+@contextmanager
+def collectResults():
+  """For the duration of the block, ResponseBuilder.finish records its result and raises CheckFinished instead of
+  exiting, and helpers raise CheckFailed.  Yields the list that finished results are appended to."""
+  previous = getattr(GLOBAL_CONFIG, 'results', None)
+  GLOBAL_CONFIG.results = []
+  try:
+    yield GLOBAL_CONFIG.results
+  finally:
+    GLOBAL_CONFIG.results = previous
+
+
+@contextmanager
+def outputTo(outfile):
+  """Sends this thread's output to outfile for the duration of the block, then restores the previous stream."""
+  previous = getattr(GLOBAL_CONFIG, 'outfile', None)
+  GLOBAL_CONFIG.outfile = outfile
   try:
+    yield outfile
+  finally:
+    GLOBAL_CONFIG.outfile = previous
+
+
+def quoteLabel(name):
+  """Quotes a perf data label, escaping single quotes by doubling them."""
+  return "'%s'" % name.replace("'", "''")
+
+
+def parseStatus(text):
+  """Returns the exit code for check output, as written by ResponseBuilder.finish."""
+  name = re.split('[|:\n]', text, 1)[0].strip()
+  if name in STATUS_NAME:
+    return STATUS_NAME.index(name)
+  return UNKNOWN
+
+
+
+class ConnectionPool(object):
+  """Keep-alive HTTP connections, pooled per (host, port, secure)."""
+
+  def __init__(self, maxPerKey = 4, maxIdle = 30, httplibModule = httplib):
+    self.httplib = httplibModule
+    self.maxPerKey = maxPerKey
+    self.maxIdle = maxIdle
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._lastEviction = time.time()
+
+
+  def acquire(self, host, port, secure, timeout):
+    """Returns a (connection, reused) pair, reusing an idle connection when one is available."""
+    self._evictIfDue()
+    key = (host, port, secure)
+    now = time.time()
+    with self._lock:
+      idle = self._idle.get(key, [])
+      while idle:
+        lastUsed, conn = idle.pop()
+        if now - lastUsed <= self.maxIdle:
+          conn.timeout = timeout
+          if conn.sock:
+            conn.sock.settimeout(timeout)
+          return conn, True
+        conn.close()
+    return self._connect(host, port, secure, timeout), False
+
+
+  def _connect(self, host, port, secure, timeout):
+    """Returns a new connection."""
     if secure:
-      conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+      return self.httplib.HTTPSConnection(host, port, timeout=timeout)
+    return self.httplib.HTTPConnection(host, port, timeout=timeout)
+
+
+  def release(self, host, port, secure, conn):
+    """Returns a connection to the pool, closing it if the pool for its endpoint is full."""
+    self._evictIfDue()
+    key = (host, port, secure)
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.maxPerKey:
+        idle.append((time.time(), conn))
+        return
+    conn.close()
+
+
+  def evictIdle(self):
+    """Closes connections that have been idle longer than maxIdle."""
+    cutoff = time.time() - self.maxIdle
+    with self._lock:
+      for key, idle in self._idle.items():
+        stale = [conn for lastUsed, conn in idle if lastUsed < cutoff]
+        self._idle[key] = [(lastUsed, conn) for lastUsed, conn in idle if lastUsed >= cutoff]
+        for conn in stale:
+          conn.close()
+
+
+  def _evictIfDue(self):
+    """Evicts idle connections of every endpoint, at most once every maxIdle seconds."""
+    now = time.time()
+    if now - self._lastEviction >= self.maxIdle:
+      self._lastEviction = now
+      self.evictIdle()
+
+
+  def clear(self):
+    """Closes all pooled connections."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for conns in idle.values():
+      for _, conn in conns:
+        conn.close()
+
+
+  def open(self, host, port, path, timeout, secure = False):
+    """GETs path, returning the connection and the unread response.  Retries once on a fresh connection if a reused
+    one turns out to be stale.  Hand the connection back with done once the response has been read."""
+    conn, reused = self.acquire(host, port, secure, timeout)
+    while True:
+      try:
+        conn.request('GET', path)
+        return conn, conn.getresponse()
+      except (socket.error, self.httplib.HTTPException), e:
+        conn.close()
+        if not reused or isinstance(e, socket.timeout):
+          raise
+      conn, reused = self._connect(host, port, secure, timeout), False
+
+
+  def done(self, host, port, secure, conn, response, complete = True):
+    """Returns a connection to the pool if its response was read completely and the server will keep it alive."""
+    if complete and not response.will_close:
+      self.release(host, port, secure, conn)
     else:
-      conn = httplib.HTTPConnection(host, port, timeout=timeout)
-    conn.request('GET', path)
-    body = conn.getresponse().read()
+      conn.close()
+
+
+  def fetch(self, host, port, path, timeout, secure = False):
+    """GETs path, returning the response body."""
+    conn, response = self.open(host, port, path, timeout, secure)
+    complete = False
+    try:
+      body = response.read()
+      complete = True
+    finally:
+      self.done(host, port, secure, conn, response, complete)
+    return body
+
+
+
+# Shared by every check running in this process.
+CONNECTION_POOL = ConnectionPool()
+
+# Connections for green checks, created on first use since it requires eventlet.
+GREEN_CONNECTION_POOL = None
+
+
+def greenConnectionPool():
+  """Returns the pool of eventlet green connections."""
+  global GREEN_CONNECTION_POOL # pylint: disable=W0603
+  if GREEN_CONNECTION_POOL is None:
+    from eventlet.green import httplib as greenHttplib
+    GREEN_CONNECTION_POOL = ConnectionPool(httplibModule=greenHttplib)
+  return GREEN_CONNECTION_POOL
+
+
+def wgetWithTimeout(host, port, path, timeout, secure = False, pool = None):
+  """Gets an http page, but times out if it's too slow."""
+  start = time.time()
+  try:
+    body = (pool or CONNECTION_POOL).fetch(host, port, path, timeout, secure)
     return time.time() - start, body
 
   except (socket.gaierror, socket.error):
-    output("CRIT: Could not connect to %s" % host)
-    exit(CRITICAL)
+    fail(CRITICAL, "CRIT: Could not connect to %s" % host)
 
   except socket.timeout:
-    output("CRIT: Timed out after %s seconds" % timeout)
-    exit(CRITICAL)
+    fail(CRITICAL, "CRIT: Timed out after %s seconds" % timeout)
+
+
+def greenWgetWithTimeout(host, port, path, timeout, secure = False):
+  """Like wgetWithTimeout, but lets other eventlet green threads run while waiting on the network."""
+  return wgetWithTimeout(host, port, path, timeout, secure, greenConnectionPool())
+
+
+class FetchResult(object):
+  """The outcome of fetching one endpoint: elapsed seconds and body, or an error message."""
+
+  __slots__ = ('host', 'port', 'path', 'elapsed', 'body', 'error')
+
+  def __init__(self, host, port, path):
+    self.host = host
+    self.port = port
+    self.path = path
+    self.elapsed = None
+    self.body = None
+    self.error = 'Timed out'
+
+
+  def __repr__(self):
+    return 'FetchResult(%r, %r, %r, elapsed=%r, error=%r)' % (self.host, self.port, self.path, self.elapsed, self.error)
+
+
+
+def fetchInto(finished, index, endpoint, timeout, secure, pool, deadline):
+  """Fetches an endpoint into a FetchResult of its own instead of exiting on failure, and stores it in
+  finished[index] if it is done before the deadline."""
+  host, port, path = endpoint
+  result = FetchResult(host, port, path)
+  start = time.time()
+  try:
+    result.body = pool.fetch(host, port, path, timeout, secure)
+    result.error = None
+  except socket.timeout:
+    result.error = 'Timed out after %s seconds' % timeout
+  except (socket.error, pool.httplib.HTTPException), e:
+    result.error = 'Could not connect to %s: %s' % (host, e)
+  except Exception, e: # ok to catch generic error # pylint: disable=W0703
+    # Anything else would end the thread and leave the result looking like a timeout.
+    result.error = 'Could not fetch from %s: %s: %s' % (host, e.__class__.__name__, e)
+  result.elapsed = time.time() - start
+  if time.time() <= deadline:
+    finished[index] = result
+
+
+def fetchMany(endpoints, timeout, secure = False, green = False):
+  """Fetches a list of (host, port, path) endpoints concurrently, all within timeout seconds.
+
+  Returns a FetchResult for each endpoint, in order.  Endpoints that fail or don't finish in time have their error set.
+  Fetches use threads, or eventlet green threads when green is set.
+  """
+  endpoints = list(endpoints)
+  # Each fetch stores its result here when it is done.  Fetches still running at the deadline keep going, so the
+  # results are copied out rather than returned in place.
+  finished = [None] * len(endpoints)
+  deadline = time.time() + timeout
+  if green:
+    import eventlet
+    pool = eventlet.GreenPool(len(endpoints) or 1)
+    connections = greenConnectionPool()
+    with eventlet.Timeout(timeout, False):
+      for index, endpoint in enumerate(endpoints):
+        pool.spawn_n(fetchInto, finished, index, endpoint, timeout, secure, connections, deadline)
+      pool.waitall()
+
+  else:
+    threads = []
+    for index, endpoint in enumerate(endpoints):
+      thread = threading.Thread(target=fetchInto,
+                                args=(finished, index, endpoint, timeout, secure, CONNECTION_POOL, deadline))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join(max(0, deadline - time.time()))
+
+  results = list(finished)
+  return [result or FetchResult(*endpoint) for result, endpoint in zip(results, endpoints)]
 
 
 def parseJson(text):
@@ -70,8 +356,312 @@ def parseJson(text):
     return json.loads(text)
 
   except ValueError, e:
-    output('CRIT: %s (text was %r)' % (e, text))
-    exit(CRITICAL)
+    fail(CRITICAL, 'CRIT: %s (text was %r)' % (e, text))
+
+
+# A complete string.
+JSON_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+# A whole run of text without strings or brackets.  The lookahead stops it from being split when a match backtracks.
+JSON_TEXT = r'[^"\[\]{}]+(?![^"\[\]{}])'
+
+# How deeply nested containers are skipped within a single regular expression match.
+JSON_NESTING = 4
+
+
+def skipJsonPattern(string):
+  """Returns a pattern matching JSON text in which every string, matched by string, and every container nested at most
+  JSON_NESTING deep is complete.  Each alternative starts with a different character, so a match that fails at the end
+  of the buffer backtracks in linear time."""
+  pattern = r'(?:%s|%s)*' % (JSON_TEXT, JSON_STRING)
+  for _ in range(JSON_NESTING):
+    pattern = r'(?:%s|%s|[\[{]%s[\]}])*' % (JSON_TEXT, JSON_STRING, pattern)
+  return r'(?:%s|%s|[\[{]%s[\]}])*' % (JSON_TEXT, string, pattern)
+
+
+# JSON text that can be skipped without tracking depth, e.g. the rest of a container.
+SKIP_JSON_RE = re.compile(skipJsonPattern(JSON_STRING))
+
+# A whole container that can be skipped without tracking depth.
+SKIP_CONTAINER_RE = re.compile(r'[\[{]%s[\]}]' % skipJsonPattern(JSON_STRING))
+
+# The rest of a string after its opening quote, up to its closing quote or the end of the buffer.
+STRING_REST_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+# A number, true, false or null.
+SCALAR_RE = re.compile(r'[^\s,:"\[\]{}]*')
+
+
+
+class JsonPathReader(object):
+  """Reads JSON incrementally from a file-like object, decoding only the values at the requested key paths.
+
+  Objects and arrays on the way to a requested path are walked; every other value is scanned past with regular
+  expressions, tracking only bracket depth and whether it is inside a string, and never decoded.  Text is dropped from
+  the buffer as soon as it has been passed, so memory use is bounded by the chunk size and the wanted values rather
+  than the document.  Reading stops as soon as every path has been found.
+  """
+
+  def __init__(self, stream, paths, chunkSize = 65536):
+    self.stream = stream
+    self.chunkSize = chunkSize
+    self.wanted = set(tuple(path) for path in paths)
+    # Every proper prefix of a wanted path, i.e. the containers that must be walked rather than skipped, mapped to the
+    # keys or indexes of their children that lead on to a wanted path.
+    self.children = {}
+    for path in self.wanted:
+      for i in range(len(path)):
+        self.children.setdefault(path[:i], set()).add(path[i])
+    self.skipMembers = {}
+    self.found = {}
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+    self.complete = False
+
+
+  def read(self):
+    """Reads and extracts, returning a dict mapping each key path that was found to its value."""
+    if self.wanted:
+      self._value(())
+      if len(self.found) < len(self.wanted):
+        # Only a fully read response leaves the connection reusable.
+        self._skipWhitespace()
+        self.complete = self.pos >= len(self.buffer)
+    return self.found
+
+
+  def _more(self):
+    """Reads another chunk into the buffer, dropping what has been consumed.  Returns False at the end of the stream."""
+    if self.eof:
+      return False
+    chunk = self.stream.read(self.chunkSize)
+    if not chunk:
+      self.eof = True
+      return False
+    # Callers consume everything they have scanned first, so at most a partial token is carried over.
+    self.buffer = self.buffer[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+
+  def _peek(self):
+    """Returns the next non-whitespace character without consuming it."""
+    self._skipWhitespace()
+    if self.pos >= len(self.buffer):
+      raise ValueError('Unexpected end of JSON')
+    return self.buffer[self.pos]
+
+
+  def _skipWhitespace(self):
+    """Consumes whitespace."""
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+        self.pos += 1
+      if self.pos < len(self.buffer) or not self._more():
+        return
+
+
+  def _expect(self, char):
+    """Consumes the given character."""
+    if self._peek() != char:
+      raise ValueError('Expected %r at offset %d' % (char, self.pos))
+    self.pos += 1
+
+
+  def _consume(self, end, pieces):
+    """Consumes the buffer up to end, appending the text to pieces if it is not None."""
+    if pieces is not None:
+      pieces.append(self.buffer[self.pos:end])
+    self.pos = end
+
+
+  def _scan(self, pieces = None, depth = 0):
+    """Consumes one value without decoding it, or with depth set, the rest of that many enclosing containers.  Appends
+    the consumed text to pieces if it is not None."""
+    if not depth:
+      char = self._peek()
+      if char == '"':
+        return self._scanString(pieces)
+      elif char not in '[{':
+        return self._scanScalar(pieces)
+      match = SKIP_CONTAINER_RE.match(self.buffer, self.pos)
+      if match:
+        return self._consume(match.end(), pieces)
+      self._consume(self.pos + 1, pieces)
+      depth = 1
+
+    while True:
+      buf = self.buffer
+      self._consume(SKIP_JSON_RE.match(buf, self.pos).end(), pieces)
+      if self.pos == len(buf):
+        if not self._more():
+          raise ValueError('Unexpected end of JSON')
+        continue
+      char = buf[self.pos]
+      if char == '"':
+        # A string that continues past the end of the buffer.
+        self._scanString(pieces)
+        continue
+      self._consume(self.pos + 1, pieces)
+      if char in '[{':
+        depth += 1
+      else:
+        depth -= 1
+        if not depth:
+          return
+
+
+  def _scanString(self, pieces = None):
+    """Consumes a string without decoding it."""
+    self._expect('"')
+    if pieces is not None:
+      pieces.append('"')
+    while True:
+      buf = self.buffer
+      end = STRING_REST_RE.match(buf, self.pos).end()
+      if end < len(buf) and buf[end] == '"':
+        self._consume(end + 1, pieces)
+        return
+      # The end of the buffer, or a backslash at its very end whose escaped character is in the next chunk.
+      self._consume(end, pieces)
+      if not self._more():
+        raise ValueError('Unterminated string')
+
+
+  def _scanScalar(self, pieces = None):
+    """Consumes a number, true, false or null without decoding it."""
+    while True:
+      buf = self.buffer
+      self._consume(SCALAR_RE.match(buf, self.pos).end(), pieces)
+      if self.pos < len(buf) or not self._more():
+        return
+
+
+  def _decode(self):
+    """Decodes one value, joining its text from every chunk it spans only once it has all been read."""
+    pieces = []
+    self._scan(pieces)
+    return json.loads(''.join(pieces))
+
+
+  def _value(self, path):
+    """Reads the value at path.  Returns True once every wanted path has been found."""
+    if path in self.children:
+      char = self._peek()
+      if char == '{':
+        return self._object(path)
+      elif char == '[':
+        return self._array(path)
+
+    if path in self.wanted:
+      self.found[path] = self._decode()
+      return len(self.found) == len(self.wanted)
+    self._scan()
+    return False
+
+
+  def _skipMembersRe(self, path):
+    """Returns a regular expression matching members of the object at path up to its end, a container nested too deeply
+    to skip in one match, or a string that may be the key of a member leading to a wanted path."""
+    if path not in self.skipMembers:
+      keys = [key.encode('utf-8') if isinstance(key, unicode) else key
+              for key in self.children[path] if isinstance(key, basestring)]
+      # Strings with escapes may be wanted keys written differently, so they are decoded too.
+      string = r'"[^"\\]*"'
+      if keys:
+        string = r'"(?!(?:%s)")[^"\\]*"' % '|'.join(re.escape(key) for key in keys)
+      self.skipMembers[path] = re.compile(skipJsonPattern(string))
+    return self.skipMembers[path]
+
+
+  def _object(self, path):
+    """Walks an object, stopping only at nested containers and at keys that may lead to a wanted path."""
+    keys = self.children[path]
+    skipMembers = self._skipMembersRe(path)
+    self._expect('{')
+    while True:
+      buf = self.buffer
+      self.pos = skipMembers.match(buf, self.pos).end()
+      if self.pos == len(buf):
+        if not self._more():
+          raise ValueError('Unexpected end of JSON')
+        continue
+      char = buf[self.pos]
+      if char == '}':
+        self.pos += 1
+        return False
+      elif char == '"':
+        key = self._decode()
+        # Only a string followed by a colon is a key; anything else is a value, which has now been passed.
+        if self._peek() == ':':
+          self.pos += 1
+          if key in keys and self._value(path + (key,)):
+            return True
+      elif char in '[{':
+        self._scan()
+      else:
+        raise ValueError('Unexpected %r at offset %d' % (char, self.pos))
+
+
+  def _array(self, path):
+    """Walks an array item by item, skipping everything after the last item that leads to a wanted path."""
+    indexes = self.children[path]
+    last = max([idx for idx in indexes if isinstance(idx, (int, long))] or [-1])
+    self._expect('[')
+    if self._peek() == ']':
+      self.pos += 1
+      return False
+    idx = 0
+    while True:
+      if idx > last:
+        self._scan(depth=1)
+        return False
+      if self._value(path + (idx,)):
+        return True
+      idx += 1
+      if self._peek() == ']':
+        self.pos += 1
+        return False
+      self._expect(',')
+
+
+
+def extractJsonPaths(stream, paths):
+  """Reads JSON from a file-like object, stopping as soon as all of the given key paths have been found.
+
+  Returns a dict mapping each path that was found to its value.  Paths are tuples of keys, as passed to lookup.
+  """
+  return JsonPathReader(stream, paths).read()
+
+
+def wgetJsonPaths(host, port, path, timeout, keyPaths, secure = False, pool = None):
+  """Gets JSON from an http page, reading only as far as needed to find the given key paths.
+
+  Returns the elapsed time and a dict mapping each key path that was found to its value.
+  """
+  pool = pool or CONNECTION_POOL
+  start = time.time()
+  try:
+    conn, response = pool.open(host, port, path, timeout, secure)
+  except (socket.gaierror, socket.error):
+    fail(CRITICAL, "CRIT: Could not connect to %s" % host)
+
+  reader = JsonPathReader(response, keyPaths)
+  try:
+    values = reader.read()
+  except socket.timeout:
+    conn.close()
+    fail(CRITICAL, "CRIT: Timed out after %s seconds" % timeout)
+  except socket.error:
+    conn.close()
+    fail(CRITICAL, "CRIT: Could not connect to %s" % host)
+  except ValueError, e:
+    conn.close()
+    fail(CRITICAL, 'CRIT: %s' % e)
+
+  pool.done(host, port, secure, conn, response, reader.complete)
+  return time.time() - start, values
 
 
 def parseJsonFile(filename):
@@ -80,8 +670,7 @@ def parseJsonFile(filename):
     with open(filename) as f:
       return parseJson(f.read())
   except IOError, e:
-    output('UNKNOWN: %s' % e)
-    exit(UNKNOWN)
+    fail(UNKNOWN, 'UNKNOWN: %s' % e)
 
 
 def lookup(source, *keys, **kw):
@@ -100,6 +689,93 @@ def statValue(data, *keys, **kw):
   return float(lookup(data, *keys, **kw))
 
 
+# Matches every child of a dict or list in a Selector path.
+WILDCARD = '*'
+
+
+
+class Selector(object):
+  """Extracts the values at many key paths from a document in a single traversal.
+
+  Paths are either dotted strings like 'stats.*.latency' or tuples of keys like ('workers', 0, 'busy'); use tuples
+  for list indexes and for keys that contain dots.  A '*' key matches every child of a dict or list, and the matched
+  keys are substituted into the name of the value.  Compile a Selector once and reuse it for every document with
+  the same shape.
+  """
+
+  def __init__(self, paths = ()):
+    # A trie of keys.  Each node is a list of [key, [names of values at key], child node] entries.
+    self._root = []
+    for name, path in paths:
+      self.add(name, path)
+
+
+  def add(self, name, path):
+    """Adds a path.  name is a format string with a %s for each wildcard in the path."""
+    if isinstance(path, basestring):
+      path = path.split('.')
+    if not path:
+      raise ValueError('Empty path')
+    node = self._root
+    for key in path:
+      for entry in node:
+        if entry[0] == key:
+          break
+      else:
+        entry = [key, [], []]
+        node.append(entry)
+      names, node = entry[1], entry[2]
+    names.append(name)
+    return self
+
+
+  def extract(self, data):
+    """Returns a list of (name, value) pairs.  Missing paths are left out, and wildcards match in sorted key order."""
+    result = []
+    self._walk(self._root, data, (), result)
+    return result
+
+
+  def _walk(self, node, source, matched, result):
+    """Adds the values under node to result.  Values are added here rather than in a call per child, since most
+    paths end one key below a wildcard."""
+    for key, names, children in node:
+      if key == WILDCARD:
+        if isinstance(source, dict):
+          keys = sorted(source)
+        elif isinstance(source, list):
+          keys = xrange(len(source))
+        else:
+          continue
+        leaves = not names and all(not grandchildren and key != WILDCARD for key, _, grandchildren in children)
+        for childKey in keys:
+          value = source[childKey]
+          childMatched = matched + (childKey,)
+          for name in names:
+            result.append((name % childMatched, value))
+          if leaves:
+            # The common 'stats.*.latency' case: look up the leaves here rather than in a call per child.
+            for leafKey, leafNames, _ in children:
+              try:
+                leaf = value[leafKey]
+              except (KeyError, IndexError, AttributeError, TypeError):
+                continue
+              for name in leafNames:
+                result.append((name % childMatched, leaf))
+          elif children:
+            self._walk(children, value, childMatched, result)
+      else:
+        try:
+          value = source[key]
+        except (KeyError, IndexError, AttributeError, TypeError):
+          continue
+        for name in names:
+          result.append((name % matched if matched else name, value))
+        if children:
+          self._walk(children, value, matched, result)
+
+
+
 def percent(value):
   """Formats the given float as a percentage."""
   return "%f%%" % (value * 100)
@@ -109,8 +785,7 @@ def parseArgs(scriptName, *args, **kw):
   """Parses arguments to the script."""
   argv = kw.get('argv', sys.argv)
   if len(argv) != len(args) + 1:
-    output('USAGE: %s %s' % (scriptName, ' '.join([name for name, _ in args])))
-    exit(UNKNOWN)
+    fail(UNKNOWN, 'USAGE: %s %s' % (scriptName, ' '.join([name for name, _ in args])))
 
   result = {}
   idx = 0
@@ -119,12 +794,108 @@ def parseArgs(scriptName, *args, **kw):
       idx += 1
       result[name] = fn(argv[idx])
     except ValueError:
-      output("Invalid value for %s: %r." % (name, argv[1]))
-      exit(UNKNOWN)
+      fail(UNKNOWN, "Invalid value for %s: %r." % (name, argv[1]))
   return result
 
 
 
+class StateStore(object):
+  """The latest (timestamp, value) sample for each key, evicting the least recently updated beyond maxEntries."""
+
+  def __init__(self, maxEntries = 10000):
+    self.maxEntries = maxEntries
+    self._samples = OrderedDict()
+    self._updated = set()
+    self._lock = threading.Lock()
+
+
+  def swap(self, key, timestamp, value):
+    """Stores a sample, returning the previous (timestamp, value) sample for key, or None."""
+    with self._lock:
+      previous = self._samples.pop(key, None)
+      self._samples[key] = (timestamp, value)
+      self._updated.add(key)
+      if len(self._samples) > self.maxEntries:
+        self._updated.discard(self._samples.popitem(last=False)[0])
+      return previous
+
+
+  def __len__(self):
+    return len(self._samples)
+
+
+  def load(self, filename):
+    """Adds the samples saved in filename.  A missing or unreadable file is treated as empty."""
+    try:
+      with open(filename) as f:
+        entries = json.load(f)
+    except (IOError, ValueError):
+      return
+    with self._lock:
+      for key, timestamp, value in entries[-self.maxEntries:]:
+        self._samples[tuple(key)] = (timestamp, value)
+
+
+  def save(self, filename):
+    """Saves the samples updated since loading.  Samples saved by other processes in the meantime are kept.  Returns
+    whether the samples could be saved."""
+    try:
+      lockFd = os.open(filename + '.lock', os.O_WRONLY | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0600)
+      with os.fdopen(lockFd, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = StateStore(self.maxEntries)
+        merged.load(filename)
+        with self._lock:
+          for key in self._updated:
+            merged.swap(key, *self._samples[key])
+        tempFd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+          with os.fdopen(tempFd, 'w') as f:
+            json.dump([[list(key), timestamp, value] for key, (timestamp, value) in merged._samples.iteritems()], f)
+          os.rename(temp, filename)
+        finally:
+          if os.path.exists(temp):
+            os.remove(temp)
+    except (IOError, OSError):
+      return False
+    return True
+
+
+# Previous samples for Delta and Rate rules.
+STATE = StateStore()
+
+# Where checks run from the command line keep STATE between invocations.
+STATE_FILE = os.path.join(os.path.expanduser('~'), '.greplin-nagios-state.json')
+
+STATE_LOADED = False
+
+
+@contextmanager
+def stateScope(*key):
+  """Keys Delta and Rate samples by the given check name and args for the duration of the block.  Used when running
+  checks in a long lived process; from the command line, samples are keyed by sys.argv and kept in STATE_FILE."""
+  previous = getattr(GLOBAL_CONFIG, 'stateScope', None)
+  GLOBAL_CONFIG.stateScope = key
+  try:
+    yield
+  finally:
+    GLOBAL_CONFIG.stateScope = previous
+
+
+def swapSample(name, timestamp, value):
+  """Stores a sample of the named stat for the current check, returning the previous (timestamp, value) or None."""
+  global STATE_LOADED # pylint: disable=W0603
+  scope = getattr(GLOBAL_CONFIG, 'stateScope', None)
+  if scope is None:
+    if not STATE_LOADED:
+      STATE_LOADED = True
+      STATE.load(STATE_FILE)
+      atexit.register(STATE.save, STATE_FILE)
+    scope = tuple(sys.argv)
+  return STATE.swap(scope + (name,), timestamp, value)
+
+
+
 class Rule(object):
   """A rule for when to warn or crit based on a stat value."""
 
@@ -133,6 +904,16 @@ class Rule(object):
     raise NotImplementedError
 
 
+  def sample(self, name, value):
+    """Returns the value to check and report for a sampled value, or None if there is nothing to report yet."""
+    return value
+
+
+  def perfData(self, name, value):
+    """Returns the perf data for a value as a PerfData."""
+    return parsePerfData(self.format(name, value))[0]
+
+
 
 class Minimum(Rule):
   """A rule that specifies minimum acceptable levels for a metric."""
@@ -157,7 +938,12 @@ class Minimum(Rule):
 
   def format(self, name, value):
     """Formats as perf data."""
-    return "'%s'=%.9g%s;%.9g;%.9g;;;" % (name, value, self.unit, self.warnLevel, self.critLevel)
+    return "%s=%.9g%s;%.9g;%.9g;;;" % (quoteLabel(name), value, self.unit, self.warnLevel, self.critLevel)
+
+
+  def perfData(self, name, value):
+    """Returns the perf data for a value as a PerfData, without formatting and parsing it."""
+    return PerfData(name, float('%.9g' % value), self.unit, '%.9g' % self.warnLevel, '%.9g' % self.critLevel)
 
 
   def message(self, name, value):
@@ -192,7 +978,12 @@ class Maximum(Rule):
 
   def format(self, name, value):
     """Formats as perf data."""
-    return "'%s'=%.9g%s;%.9g;%.9g;;;" % (name, value, self.unit, self.warnLevel, self.critLevel)
+    return "%s=%.9g%s;%.9g;%.9g;;;" % (quoteLabel(name), value, self.unit, self.warnLevel, self.critLevel)
+
+
+  def perfData(self, name, value):
+    """Returns the perf data for a value as a PerfData, without formatting and parsing it."""
+    return PerfData(name, float('%.9g' % value), self.unit, '%.9g' % self.warnLevel, '%.9g' % self.critLevel)
 
 
   def message(self, name, value):
@@ -205,18 +996,81 @@ class Maximum(Rule):
 
 
 
+class Delta(Rule):
+  """Checks the change in a counter since the previous run of the same check with the same args against another
+  rule.  A counter that went down is taken to have been reset to zero.  Nothing is reported on the first run."""
+
+  def __init__(self, rule):
+    Rule.__init__(self)
+    self.rule = rule
+
+
+  def sample(self, name, value):
+    """Returns the change since the previous sample, or None if there is none."""
+    timestamp = time.time()
+    value = float(value)
+    previous = swapSample(name, timestamp, value)
+    if previous is None:
+      return None
+    lastTime, lastValue = previous
+    return self.change(value - lastValue if value >= lastValue else value, timestamp - lastTime)
+
+
+  def change(self, delta, elapsed):
+    """Returns the value to check given the change in the counter and the seconds since the previous sample."""
+    return delta
+
+
+  def check(self, value):
+    """Checks the change against the rule."""
+    return self.rule.check(value)
+
+
+  def format(self, name, value):
+    """Formats as perf data."""
+    return self.rule.format(name, value)
+
+
+  def perfData(self, name, value):
+    """Returns the perf data for a value as a PerfData."""
+    return self.rule.perfData(name, value)
+
+
+  def message(self, name, value):
+    """Create an error message."""
+    return self.rule.message(name, value)
+
+
+
+class Rate(Delta):
+  """Checks the per second rate of change of a counter against another rule, e.g. Rate(Maximum(10, 100, '/s'))."""
+
+  def change(self, delta, elapsed):
+    """Returns the change per second."""
+    if elapsed <= 0:
+      return None
+    return delta / elapsed
+
+
+
 class ResponseBuilder(object):
   """NRPE response builder."""
 
-  def __init__(self):
+  def __init__(self, outfile = None):
     self._stats = []
+    # (build, name, value) for each stat.  build(name, value) returns its PerfData, which is only needed while results
+    # are being collected.
+    self._perfdata = []
     self._status = OK
     self._messages = [[], [], [], []]
+    self.outfile = outfile
 
 
   def addValue(self, name, value):
     """Adds a value to be tracked."""
-    self._stats.append("'%s'=%s;;;;;" % (name, str(value)))
+    text = str(value)
+    self._stats.append("%s=%s;;;;;" % (quoteLabel(name), text))
+    self._perfdata.append((valuePerfData, name, text))
     return self
 
 
@@ -235,14 +1089,52 @@ class ResponseBuilder(object):
     return self
 
 
+  def addSelected(self, selector, data, rule = None, suffix = ''):
+    """Adds every value a Selector extracts from data, checked against rule if one is given."""
+    if rule is not None:
+      for name, value in selector.extract(data):
+        self.addRule(name, rule, value)
+      return self
+
+    for name, value in selector.extract(data):
+      if suffix or not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        self.addValue(name, str(value) + suffix)
+      else:
+        # Numbers need neither formatting nor parsing.
+        text = str(value)
+        self._stats.append("%s=%s;;;;;" % (quoteLabel(name), text))
+        self._perfdata.append((valuePerfData, name, text))
+    return self
+
+
+  def addFetches(self, results, maxFailures = 0, label = '%s latency'):
+    """Adds latency perf data for each fetchMany result.  Warns about failed fetches, but only goes CRIT when more
+    than maxFailures failed."""
+    failures = []
+    for result in results:
+      endpoint = '%s:%s%s' % (result.host, result.port, result.path)
+      if result.error:
+        failures.append('%s: %s' % (endpoint, result.error))
+      else:
+        self.addValue(label % endpoint, '%.6fs' % result.elapsed)
+    if len(failures) > maxFailures:
+      self.crit('%d of %d fetches failed (%s)' % (len(failures), len(results), ', '.join(failures)))
+    elif failures:
+      self.warn('%d of %d fetches failed (%s)' % (len(failures), len(results), ', '.join(failures)))
+    return self
+
+
   def addRule(self, name, rule, value):
     """Adds an alert rule and associated performance data."""
+    value = rule.sample(name, value)
+    if value is None:
+      return self
     status = rule.check(value)
     if status:
-      ruleStatus = rule.check(value)
-      self._status = max(self._status, ruleStatus)
-      self._messages[ruleStatus].append(rule.message(name, value))
+      self._status = max(self._status, status)
+      self._messages[status].append(rule.message(name, value))
     self._stats.append(rule.format(name, value))
+    self._perfdata.append((rule.perfData, name, value))
     return self
 
 
@@ -303,14 +1195,181 @@ class ResponseBuilder(object):
     return ' '.join(self._stats)
 
 
-  def finish(self):
-    """Builds the response, prints it, and exits."""
+  def _messageText(self):
+    """Returns the messages, most severe first."""
+    return ', '.join(self._messages[UNKNOWN] + self._messages[CRITICAL] + self._messages[WARNING] +
+                     self._messages[OK])
+
+
+  def _text(self, messages):
+    """Returns the response as printed: status, messages and perf data."""
     status = STATUS_NAME[self._status]
-    messages = self._messages[UNKNOWN] + self._messages[CRITICAL] + self._messages[WARNING] + self._messages[OK]
     if messages:
-      status += ': ' + (', '.join(messages))
+      status += ': ' + messages
     if self._stats:
       status += '|' + self.build()
+    return status
+
+
+  def result(self):
+    """Builds the response as a CheckOutput."""
+    messages = self._messageText()
+    perfdata = [build(name, value) for build, name, value in self._perfdata]
+    return CheckOutput(self._status, messages, [], perfdata, self._text(messages))
+
 
-    output(status)
+  def finish(self):
+    """Builds the response, prints it, and exits.  While results are being collected, records it and raises
+    CheckFinished instead."""
+    if getattr(GLOBAL_CONFIG, 'results', None) is not None:
+      GLOBAL_CONFIG.results.append(self.result())
+      raise CheckFinished()
+
+    output(self._text(self._messageText()), self.outfile)
     sys.exit(self._status)
+
+
+
+# A perf data item: a label, quoted or not, then = and the semicolon separated value fields.
+PERFDATA_RE = re.compile(r"""(?:'((?:[^']|'')*)'|([^\s'=]+))=(\S*)""")
+
+# A value, optionally followed by a unit of measure.
+VALUE_RE = re.compile(r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(.*)$')
+
+
+
+class PerfData(object):
+  """A single perf data item. warn and crit are range strings, min and max are floats, any of them may be None."""
+
+  __slots__ = ('label', 'value', 'unit', 'warn', 'crit', 'min', 'max')
+
+  def __init__(self, label, value, unit = '', warn = None, crit = None, minimum = None, maximum = None):
+    self.label = label
+    self.value = value
+    self.unit = unit
+    self.warn = warn
+    self.crit = crit
+    self.min = minimum
+    self.max = maximum
+
+
+  def __repr__(self):
+    return 'PerfData(%r, %r, %r, %r, %r, %r, %r)' % (
+        self.label, self.value, self.unit, self.warn, self.crit, self.min, self.max)
+
+
+
+class CheckOutput(object):
+  """A check result: status code, message, long output lines, perf data and the full output text."""
+
+  __slots__ = ('status', 'message', 'longOutput', 'perfdata', 'text')
+
+  def __init__(self, status, message, longOutput, perfdata, text = None):
+    self.status = status
+    self.message = message
+    self.longOutput = longOutput
+    self.perfdata = perfdata
+    self.text = text
+
+
+  def values(self):
+    """Returns a dict mapping each perf data label to its value."""
+    return dict((item.label, item.value) for item in self.perfdata)
+
+
+  def toJson(self):
+    """Returns the result as a dict that can be serialized to JSON."""
+    return {
+      'status': self.status,
+      'message': self.message,
+      'longOutput': self.longOutput,
+      'perfdata': [dict((key, getattr(item, key)) for key in PerfData.__slots__) for item in self.perfdata],
+      'text': self.text
+    }
+
+
+  def __repr__(self):
+    return 'CheckOutput(%r, %r, %r, %r, %r)' % (self.status, self.message, self.longOutput, self.perfdata, self.text)
+
+
+
+def parseNumber(text):
+  """Parses a float, returning None for empty or invalid text."""
+  try:
+    return float(text)
+  except ValueError:
+    return None
+
+
+def parseValue(text):
+  """Parses a perf data value and its unit of measure. Values that aren't numbers are returned as is."""
+  try:
+    return float(text), ''
+  except ValueError:
+    match = VALUE_RE.match(text)
+    if match:
+      return float(match.group(1)), match.group(2)
+    return text, ''
+
+
+def valuePerfData(name, text):
+  """Returns the perf data of a value added without a rule."""
+  return PerfData(name, *parseValue(text))
+
+
+def parsePerfData(text):
+  """Parses a space separated list of perf data items."""
+  result = []
+  for match in PERFDATA_RE.finditer(text):
+    quoted, label, fields = match.groups()
+    if label is None:
+      label = quoted.replace("''", "'")
+    fields = fields.split(';')
+
+    try:
+      item = PerfData(label, float(fields[0]))
+    except ValueError:
+      item = PerfData(label, *parseValue(fields[0]))
+    if len(fields) > 1:
+      item.warn = fields[1] or None
+      if len(fields) > 2:
+        item.crit = fields[2] or None
+        if len(fields) > 3:
+          item.min = parseNumber(fields[3])
+          if len(fields) > 4:
+            item.max = parseNumber(fields[4])
+    result.append(item)
+  return result
+
+
+def parseResponse(text):
+  """Parses plugin output, as written by ResponseBuilder.finish, into a CheckOutput.
+
+  Follows the Nagios plugin output format: the first line is 'TEXT|PERFDATA', followed by optional long output lines,
+  the last of which may also be followed by '|' and perf data that continues to the end of the output.
+  """
+  lines = text.split('\n')
+  if lines and not lines[-1]:
+    lines.pop()
+  if not lines:
+    return CheckOutput(UNKNOWN, '', [], [], text)
+
+  first, _, perf = lines[0].partition('|')
+  first = first.rstrip()
+  perfText = [perf]
+  longOutput = []
+  for idx in xrange(1, len(lines)):
+    line, sep, perf = lines[idx].partition('|')
+    longOutput.append(line.rstrip() if sep else line)
+    if sep:
+      perfText.append(perf)
+      perfText.extend(lines[idx + 1:])
+      break
+
+  status = parseStatus(first)
+  message = first
+  if status != UNKNOWN or first.startswith(STATUS_NAME[UNKNOWN]):
+    name = STATUS_NAME[status]
+    message = first[len(name) + 2:] if first.startswith(name + ': ') else first[len(name):].strip()
+
+  return CheckOutput(status, message, longOutput, parsePerfData(' '.join(perfText)), text)
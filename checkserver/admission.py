@@ -0,0 +1,63 @@
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control: concurrency limits with bounded wait queues."""
+
+from eventlet import semaphore
+
+
+
+class Lane(object):
+  """Lets at most limit callers run at once. Up to maxQueue more wait, each for at most maxWait seconds."""
+
+  def __init__(self, limit, maxQueue, maxWait):
+    self.limit = limit
+    self.maxQueue = maxQueue
+    self.maxWait = maxWait
+    self.running = 0
+    self.waiting = 0
+    self.rejected = 0
+    self._semaphore = semaphore.Semaphore(limit)
+
+
+  def acquire(self):
+    """Waits for a slot. Returns False if the queue is full or the wait times out."""
+    if self._semaphore.acquire(blocking=False):
+      self.running += 1
+      return True
+    if self.waiting >= self.maxQueue:
+      self.rejected += 1
+      return False
+
+    self.waiting += 1
+    try:
+      admitted = self._semaphore.acquire(timeout=self.maxWait)
+    finally:
+      self.waiting -= 1
+    if admitted:
+      self.running += 1
+    else:
+      self.rejected += 1
+    return admitted
+
+
+  def release(self):
+    """Frees a slot."""
+    self.running -= 1
+    self._semaphore.release()
+
+
+  def stats(self):
+    """Returns a dict of the lane's state."""
+    return {'limit': self.limit, 'running': self.running, 'waiting': self.waiting, 'rejected': self.rejected}
@@ -18,19 +18,14 @@
 CHECK=$1
 shift
 
-# Build the rest of the arguments into the arg string for the URL.
-CHECK_ARGS='arg='
-if [ "$#" -gt "0" ]
-then
-  CHECK_ARGS="arg="$1
-  shift
-  for ARG in "$@"
-  do
-    CHECK_ARGS=${CHECK_ARGS}"&arg="${ARG}
-  done
-fi
+# URL-encode each remaining argument as an arg= parameter.
+CHECK_ARGS=()
+for ARG in "$@"
+do
+  CHECK_ARGS+=(--data-urlencode "arg=${ARG}")
+done
 
-RESULT=`curl -s http://localhost:8111/check/${CHECK}?${CHECK_ARGS}`
+RESULT=`curl -s -G http://localhost:8111/check/${CHECK} "${CHECK_ARGS[@]}"`
 echo $RESULT
 
 IFS='|:'
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client for checkserver."""
+
+import errno
+import httplib
+import imp
+import json
+import os
+import re
+import shlex
+import socket
+import sys
+import urllib
+from cStringIO import StringIO
+from optparse import OptionParser
+
+
+# greplin.nagios is only imported to run checks locally, since importing it takes many times longer than asking the
+# checkserver.  These mirror its exit codes and parseStatus.
+UNKNOWN = 3
+
+STATUS_NAME = ['OK', 'WARN', 'CRIT', 'UNKNOWN']
+
+
+
+class CheckClient(object):
+  """Talks to a checkserver over a single persistent connection."""
+
+  def __init__(self, host = 'localhost', port = 8111, timeout = 60):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self._conn = None
+
+
+  def _request(self, method, path, body = None, headers = None):
+    """Sends a request, reconnecting once if the kept-alive connection was dropped.  Other failures, timeouts
+    included, are not retried, since the server may already have run the request."""
+    reused = self._conn is not None
+    while True:
+      if self._conn is None:
+        self._conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+      try:
+        self._conn.request(method, path, body, headers or {})
+        return self._conn.getresponse()
+      except (httplib.HTTPException, socket.error), e:
+        self.close()
+        if not reused or not isDropped(e):
+          raise
+      reused = False
+
+
+  def close(self):
+    """Closes the connection."""
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+
+  def check(self, name, args):
+    """Runs a check on the server, returning its output."""
+    path = '/check/%s?%s' % (urllib.quote(name), urllib.urlencode([('arg', arg) for arg in args]))
+    response = self._request('GET', path)
+    body = response.read()
+    if response.status == 404:
+      return 'UNKNOWN: No such check: %s' % name
+    if response.status != 200:
+      return 'UNKNOWN: checkserver returned %d %s' % (response.status, response.reason)
+    return body
+
+
+  def batch(self, entries):
+    """Runs (name, args) entries on the server, yielding result dicts in the order they finish."""
+    body = json.dumps([{'name': name, 'args': list(args)} for name, args in entries])
+    response = self._request('POST', '/batch', body, {'Content-Type': 'application/json'})
+    if response.status != 200:
+      response.read()
+      raise IOError('Batch request failed: %d %s' % (response.status, response.reason))
+
+    pending = ''
+    for chunk in readChunks(response):
+      pending += chunk
+      lines = pending.split('\n')
+      pending = lines.pop()
+      for line in lines:
+        if line:
+          yield json.loads(line)
+
+
+
+def isDropped(error):
+  """Whether a request failed because the server had closed the kept-alive connection it was sent on."""
+  if isinstance(error, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+    return True
+  return isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET)
+
+
+def readChunks(response):
+  """Yields the body of a response as it arrives, rather than waiting for all of it."""
+  if not response.chunked:
+    yield response.read()
+    return
+
+  while True:
+    size = int(response.fp.readline().split(';', 1)[0], 16)
+    if not size:
+      # Skip any trailers.
+      while response.fp.readline() not in ('\r\n', '\n', ''):
+        pass
+      break
+    yield response.fp.read(size)
+    response.fp.readline()
+  response.close()
+
+
+def parseStatus(text):
+  """Returns the exit code for check output."""
+  name = re.split('[|:\n]', text, 1)[0].strip()
+  if name in STATUS_NAME:
+    return STATUS_NAME.index(name)
+  return UNKNOWN
+
+
+def runLocally(checkdir, name, args):
+  """Runs a check in this process, the way checkserver would, returning its output."""
+  from greplin import nagios
+
+  filename = os.path.join(checkdir, 'check_%s.py' % name)
+  if not os.path.exists(filename):
+    return 'UNKNOWN: No such check: %s' % name
+  with nagios.outputTo(StringIO()) as outStream:
+    try:
+      imp.load_source('check_%s' % name, filename).check(['check_%s' % name] + args)
+    except SystemExit:
+      pass
+    except Exception, e: # ok to catch generic error # pylint: disable=W0703
+      return 'CRIT: Checker exception: %s' % e
+    return outStream.getvalue()
+
+
+def parseBatchLine(line):
+  """Parses a 'name arg arg ...' line, using shell quoting rules."""
+  parts = shlex.split(line)
+  return parts[0], parts[1:]
+
+
+def main():
+  """Run the client."""
+  parser = OptionParser(usage='%prog [options] NAME [ARG ...]\n       %prog [options] --batch < checks')
+  parser.add_option("-H", "--host", dest="host", metavar="HOST",
+                    help="checkserver host", default='localhost')
+  parser.add_option("-p", "--port", dest="port", metavar="PORT",
+                    help="checkserver port", default=8111, type="int")
+  parser.add_option("-t", "--timeout", dest="timeout", metavar="SECONDS",
+                    help="socket timeout", default=60, type="float")
+  parser.add_option("-b", "--batch", dest="batch", action="store_true", default=False,
+                    help="read one 'name arg arg ...' check per line from stdin and print one JSON result per line")
+  parser.add_option("-f", "--fallback-dir", dest="fallbackdir", metavar="DIR",
+                    help="run the check locally from DIR if checkserver cannot be reached", default=None)
+  parser.disable_interspersed_args()
+  options, args = parser.parse_args()
+
+  client = CheckClient(options.host, options.port, options.timeout)
+  if options.batch:
+    entries = [parseBatchLine(line) for line in sys.stdin if line.strip()]
+    for result in client.batch(entries):
+      sys.stdout.write(json.dumps(result) + '\n')
+      sys.stdout.flush()
+    return
+
+  if not args:
+    parser.print_usage()
+    sys.exit(UNKNOWN)
+
+  name, checkArgs = args[0], args[1:]
+  try:
+    output = client.check(name, checkArgs)
+  except (socket.error, httplib.HTTPException), e:
+    if options.fallbackdir:
+      output = runLocally(options.fallbackdir, name, checkArgs)
+    else:
+      output = 'UNKNOWN: Could not reach checkserver: %s' % (str(e) or e.__class__.__name__)
+
+  sys.stdout.write(output if output.endswith('\n') else output + '\n')
+  sys.exit(parseStatus(output))
+
+
+if __name__ == '__main__':
+  main()
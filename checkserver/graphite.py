@@ -0,0 +1,113 @@
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched, non-blocking reporting of metrics to Graphite."""
+
+import cPickle
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import defaultdict, deque
+
+
+
+class GraphiteReporter(threading.Thread):
+  """Buffers metrics in a bounded queue and sends them to Graphite in batches from a background thread.
+
+  enqueue never blocks: when the buffer is full, new metrics are dropped and counted.
+  """
+
+  def __init__(self, host, port, interval = 5, batchSize = 500, bufferSize = 100000, protocol = 'plaintext'):
+    threading.Thread.__init__(self, name='GraphiteReporter')
+    self.daemon = True
+    self.host = host
+    self.port = port
+    self.interval = interval
+    self.batchSize = batchSize
+    self.bufferSize = bufferSize
+    self.encode = {'plaintext': encodePlaintext, 'pickle': encodePickle}[protocol]
+    self.stats = defaultdict(int)
+    self._buffer = deque()
+    self._wake = threading.Event()
+    self._sock = None
+    self._backoff = 0
+
+
+  def enqueue(self, name, value, timestamp = None):
+    """Queues a metric to be sent."""
+    if len(self._buffer) >= self.bufferSize:
+      self.stats['dropped'] += 1
+      return
+    self._buffer.append((name, value, timestamp or time.time()))
+    if len(self._buffer) >= self.batchSize:
+      self._wake.set()
+
+
+  def run(self):
+    """Sends batches every interval, or sooner when a full batch is waiting."""
+    while True:
+      self._wake.wait(self.interval)
+      self._wake.clear()
+      try:
+        self._flush()
+      except Exception: # ok to catch generic error # pylint: disable=W0703
+        logging.exception('Unexpected error reporting to graphite')
+        self.stats['errors'] += 1
+
+
+  def _flush(self):
+    """Sends everything buffered, in batches."""
+    while self._buffer:
+      batch = []
+      while self._buffer and len(batch) < self.batchSize:
+        batch.append(self._buffer.popleft())
+      if not self._send(batch):
+        # Put the batch back if there's room and wait for the next interval to retry.
+        self._buffer.extendleft(reversed(batch[:max(0, self.bufferSize - len(self._buffer))]))
+        break
+
+
+  def _send(self, batch):
+    """Sends a batch, reconnecting with exponential backoff. Returns whether the batch was sent."""
+    try:
+      if self._sock is None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.interval)
+      self._sock.sendall(self.encode(batch))
+    except socket.error, e:
+      logging.warning('Could not send %d metrics to graphite at %s:%d: %s', len(batch), self.host, self.port, e)
+      self.stats['errors'] += 1
+      if self._sock is not None:
+        self._sock.close()
+        self._sock = None
+      self._backoff = min(max(self._backoff * 2, 1), 60)
+      time.sleep(self._backoff)
+      return False
+
+    self._backoff = 0
+    self.stats['sent'] += len(batch)
+    return True
+
+
+
+def encodePlaintext(batch):
+  """Encodes metrics for Graphite's plaintext protocol."""
+  return ''.join('%s %s %d\n' % (name, value, timestamp) for name, value, timestamp in batch)
+
+
+def encodePickle(batch):
+  """Encodes metrics for Graphite's pickle protocol."""
+  payload = cPickle.dumps([(name, (int(timestamp), value)) for name, value, timestamp in batch], protocol=2)
+  return struct.pack('!L', len(payload)) + payload
@@ -0,0 +1,192 @@
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory registry of check metrics, exposed in OpenMetrics text format."""
+
+import bisect
+import time
+from collections import defaultdict, deque
+
+from greplin.nagios import STATUS_NAME
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Upper bounds, in seconds, of the check duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Percentiles reported for each phase.
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+
+class Histogram(object):
+  """Cumulative histogram of observed values."""
+
+  def __init__(self, buckets = DURATION_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.total = 0.0
+    self.count = 0
+
+
+  def observe(self, value):
+    """Adds a value."""
+    idx = bisect.bisect_left(self.buckets, value)
+    if idx < len(self.counts):
+      self.counts[idx] += 1
+    self.total += value
+    self.count += 1
+
+
+
+class Window(object):
+  """The values observed over the last few minutes, for computing percentiles."""
+
+  def __init__(self, seconds = 300, maxSamples = 1000):
+    self.seconds = seconds
+    self._samples = deque(maxlen=maxSamples)
+
+
+  def observe(self, value):
+    """Adds a value."""
+    self._samples.append((time.time(), value))
+
+
+  def percentiles(self, quantiles = QUANTILES):
+    """Returns a list of the values at the given quantiles, and the number of values they were computed from."""
+    cutoff = time.time() - self.seconds
+    while self._samples and self._samples[0][0] < cutoff:
+      self._samples.popleft()
+    values = sorted(value for _, value in self._samples)
+    if not values:
+      return [None] * len(quantiles), 0
+    return [values[min(len(values) - 1, int(q * len(values)))] for q in quantiles], len(values)
+
+
+
+class Registry(object):
+  """Latest perf data and execution stats for each check."""
+
+  def __init__(self):
+    # Maps (name, args) to the latest {label: value} perf data
+    self.perfdata = {}
+    self.durations = defaultdict(Histogram)
+    # Maps (name, status) to a count of results
+    self.results = defaultdict(int)
+    self.errors = defaultdict(int)
+    # Maps (name, phase) to a Window of phase durations
+    self.phases = defaultdict(Window)
+
+
+  def record(self, name, args, duration, status, perfdata, error = False):
+    """Records one execution of a check."""
+    self.durations[name].observe(duration)
+    self.results[(name, status)] += 1
+    if error:
+      self.errors[name] += 1
+    if perfdata:
+      self.perfdata[(name, tuple(args[1:]))] = dict((k, v) for k, v in perfdata.iteritems()
+                                                    if isinstance(v, (int, long, float)))
+
+
+  def recordPhases(self, name, **durations):
+    """Records how long each phase of a check request took."""
+    for phase, duration in durations.iteritems():
+      self.phases[(name, phase)].observe(duration)
+
+
+  def phasePercentiles(self):
+    """Returns {name: {phase: {'p50': ..., 'p95': ..., 'p99': ..., 'count': ...}}} over the sliding windows."""
+    result = defaultdict(dict)
+    for (name, phase), window in self.phases.items():
+      values, count = window.percentiles()
+      stats = dict(('p%d' % (q * 100), value) for q, value in zip(QUANTILES, values))
+      stats['count'] = count
+      result[name][phase] = stats
+    return result
+
+
+  def forget(self, name):
+    """Drops the perf data of a check, e.g. when it is reloaded."""
+    for key in self.perfdata.keys():
+      if key[0] == name:
+        del self.perfdata[key]
+
+
+  def render(self, requests, cache, lanes):
+    """Renders all metrics, plus the given request, cache and admission lane stats, in OpenMetrics text format."""
+    lines = []
+
+    lines.append('# TYPE checkserver_requests counter')
+    for name, count in sorted(requests.items()):
+      lines.append(sample('checkserver_requests_total', {'check': name}, count))
+
+    lines.append('# TYPE checkserver_cache counter')
+    for result, count in sorted(cache.items()):
+      lines.append(sample('checkserver_cache_total', {'result': result}, count))
+
+    for stat, metricType in (('running', 'gauge'), ('waiting', 'gauge'), ('rejected', 'counter')):
+      metric = 'checkserver_admission_%s' % stat
+      lines.append('# TYPE %s %s' % (metric, metricType))
+      for lane, stats in sorted(lanes.items()):
+        suffix = '_total' if metricType == 'counter' else ''
+        lines.append(sample(metric + suffix, {'lane': lane}, stats[stat]))
+
+    lines.append('# TYPE checkserver_results counter')
+    for (name, status), count in sorted(self.results.items()):
+      lines.append(sample('checkserver_results_total', {'check': name, 'status': STATUS_NAME[status]}, count))
+
+    lines.append('# TYPE checkserver_errors counter')
+    for name, count in sorted(self.errors.items()):
+      lines.append(sample('checkserver_errors_total', {'check': name}, count))
+
+    lines.append('# TYPE checkserver_duration_seconds histogram')
+    lines.append('# UNIT checkserver_duration_seconds seconds')
+    for name, histogram in sorted(self.durations.items()):
+      cumulative = 0
+      for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(sample('checkserver_duration_seconds_bucket', {'check': name, 'le': '%g' % bound}, cumulative))
+      lines.append(sample('checkserver_duration_seconds_bucket', {'check': name, 'le': '+Inf'}, histogram.count))
+      lines.append(sample('checkserver_duration_seconds_sum', {'check': name}, histogram.total))
+      lines.append(sample('checkserver_duration_seconds_count', {'check': name}, histogram.count))
+
+    lines.append('# TYPE checkserver_phase_seconds summary')
+    lines.append('# UNIT checkserver_phase_seconds seconds')
+    for (name, phase), window in sorted(self.phases.items()):
+      values, _ = window.percentiles()
+      for q, value in zip(QUANTILES, values):
+        if value is not None:
+          lines.append(sample('checkserver_phase_seconds', {'check': name, 'phase': phase, 'quantile': q}, value))
+
+    lines.append('# TYPE checkserver_perfdata gauge')
+    for (name, args), values in sorted(self.perfdata.items()):
+      for label, value in sorted(values.items()):
+        lines.append(sample('checkserver_perfdata', {'check': name, 'args': ' '.join(args), 'label': label}, value))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+
+def escape(value):
+  """Escapes a label value."""
+  return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sample(metric, labels, value):
+  """Formats one sample line."""
+  labelText = ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+  return '%s{%s} %s' % (metric, labelText, repr(float(value)) if isinstance(value, float) else value)
@@ -15,60 +15,552 @@
 
 """Server that runs Python checks."""
 
-from eventlet import wsgi, tpool
+from eventlet import wsgi, tpool, event, semaphore
 import eventlet
-from flask import Flask, request, make_response, jsonify, abort
+from eventlet.queue import Queue
+from flask import Flask, Response, request, make_response, jsonify, abort
 APP = Flask(__name__)
 
+import cProfile
 import imp
+import json
 import os
 import logging
+import marshal
+import pstats
+import random
+import re
+import time
 from optparse import OptionParser
 from collections import defaultdict
 from cStringIO import StringIO
-from eloise import nagios
-from greplin.nagios import GLOBAL_CONFIG
+from greplin.nagios import UNKNOWN, CheckFailed, CheckFinished, collectResults, outputTo, parseResponse, stateScope
+from admission import Lane
+from graphite import GraphiteReporter
+from metrics import Registry, CONTENT_TYPE
+from workers import ProcessPool, WorkerDied, WorkerError, WorkerTimeout
 
 # Cache mapping check names to checker modules
 CHECK_CACHE = {}
+# Modification times of the files CHECK_CACHE modules were loaded from
+CHECK_MTIMES = {}
+# Errors from the last failed reload of each check, which keeps running its last good version
+LOAD_ERRORS = {}
+# Names of the checks in the check directory, kept up to date when watching it
+KNOWN_CHECKS = None
+# Whether startup preloading and warm-up are finished
+READY = True
+# Seconds each check module took to import at startup
+IMPORT_TIMES = {}
+# Check module filenames
+CHECK_FILE_RE = re.compile(r'^check_(.+)\.py$')
 # Arg parser options
 OPTIONS = None
 # Stats on how many times each checker has run
 STATS = defaultdict(int)
 # Graphite reporter
 GRAPHITE = None
+# Cached check results, mapping (name, args) to (expiry time, CheckOutput)
+RESULT_CACHE = {}
+# Events for checks currently executing, mapping (name, args) to an Event that receives the result
+IN_FLIGHT = {}
+# Stats on result cache hits, misses and coalesced requests
+CACHE_STATS = defaultdict(int)
+# Worker processes for checks that set ISOLATED
+PROCESS_POOL = None
+# Check modules loaded in a worker process, mapping filename to (mtime, module)
+WORKER_CACHE = {}
+# Result for checks that pass their deadline
+TIMED_OUT = parseResponse('UNKNOWN: timed out')
+# Result for ISOLATED checks whose worker process exits while running them
+WORKER_DIED = parseResponse('UNKNOWN: worker died')
+# Output prefix for checks that raise an exception
+CHECKER_EXCEPTION = 'CRIT: Checker exception: '
+# Latest perf data and execution stats for /metrics
+METRICS = Registry()
+# Result for checks turned away because the server is overloaded
+OVERLOADED = parseResponse('UNKNOWN: checkserver overloaded')
+# Global concurrency limit for checks, and a separate one for checks that set FAST
+LANES = {}
+# Concurrency limits for checks that set MAX_CONCURRENCY
+CHECK_LANES = {}
+# Threads kept in eventlet's thread pool beyond the concurrency limits, for loading checks
+RESERVED_THREADS = 1
+# How often to profile each check, mapping check name to N, to profile one in every N runs
+PROFILE_RATES = {}
+# Runs of each profiled check so far
+PROFILE_COUNTS = defaultdict(int)
+# Accumulated profiles of each profiled check, as pstats.Stats
+PROFILES = {}
+# Scheduled checks, mapping (name, args) to their schedule entry
+SCHEDULE = {}
+# Latest results of scheduled checks, mapping (name, args) to (finish time, CheckOutput)
+LATEST = {}
 
 
 def runChecker(fun, name, args):
-  """Run a checker function with the given args. Return a string."""
-  outStream = StringIO()
-  GLOBAL_CONFIG.outfile = outStream
+  """Run a checker function with the given args. Return a CheckOutput."""
+  with outputTo(StringIO()) as outStream, collectResults() as results, stateScope(name, *args[1:]):
+    try:
+      fun(args)
+    except CheckFinished:
+      return results[0]
+    except CheckFailed, e:
+      return e.result()
+    except SystemExit:
+      pass
+    except Exception, e:
+      logging.exception('Checker %s failed', name)
+      return parseResponse(CHECKER_EXCEPTION + str(e))
+
+    if results:
+      return results[0]
+    # The check wrote its output directly rather than finishing a ResponseBuilder.
+    return parseResponse(outStream.getvalue())
+
+
+def checkFilename(name):
+  """Get the filename of a check module."""
+  return os.path.join(os.path.dirname(__file__), OPTIONS.checkdir, 'check_%s.py' % name)
+
+
+def loadModule(name, filename):
+  """Load a check module from source, without touching any previously loaded version."""
+  with open(filename) as f:
+    code = compile(f.read(), filename, 'exec')
+  module = imp.new_module('check_%s' % name)
+  module.__file__ = filename
+  exec code in module.__dict__ # pylint: disable=W0122
+  return module
+
+
+def runIsolated(filename, name, args):
+  """Run a check from the given file. Called in worker processes, which keep their own module cache."""
+  mtime = os.path.getmtime(filename)
+  cached = WORKER_CACHE.get(filename)
+  if not cached or cached[0] != mtime:
+    cached = WORKER_CACHE[filename] = (mtime, loadModule(name, filename))
+  return runChecker(cached[1].check, name, args)
+
+
+def loadCheck(name, background=False):
+  """Load a check into CHECK_CACHE. On failure, records the error and keeps the last good version.
+
+  With background set, the module is compiled and executed on a thread so other requests keep being served;
+  the caches are still only updated from the hub."""
+  filename = checkFilename(name)
+  mtime = os.path.getmtime(filename)
   try:
-    fun(args)
-  except SystemExit:
-    pass
-  except Exception, e:
-    logging.exception('Checker %s failed', name)
-    return 'CRIT: Checker exception: %s' % e
-  return outStream.getvalue()
+    if background:
+      module = tpool.execute(loadModule, name, filename)
+    else:
+      module = loadModule(name, filename)
+  except Exception, e: # ok to catch generic error # pylint: disable=W0703
+    logging.exception('Could not load %s', filename)
+    LOAD_ERRORS[name] = '%s: %s' % (e.__class__.__name__, e)
+    CHECK_MTIMES[name] = mtime
+    if name not in CHECK_CACHE:
+      raise
+    return
+
+  CHECK_CACHE[name] = module
+  CHECK_MTIMES[name] = mtime
+  LOAD_ERRORS.pop(name, None)
 
 
 def checker(name):
   """Get a checker function. Caches imports. Writes output to outfile."""
   if name not in CHECK_CACHE:
-    filename = os.path.join(os.path.dirname(__file__), OPTIONS.checkdir, 'check_%s.py' % name)
-    if os.path.exists(filename):
-      CHECK_CACHE[name] = imp.load_source('check_%s' % name, filename)
+    filename = checkFilename(name)
+    # When watching the check directory, it is already known which checks exist.
+    exists = name in KNOWN_CHECKS if KNOWN_CHECKS is not None else os.path.exists(filename)
+    if exists:
+      loadCheck(name)
     else:
       raise KeyError('No such file: %s' % filename)
 
-  return lambda args: runChecker(CHECK_CACHE[name].check, name, args)
+  module = CHECK_CACHE[name]
+  return lambda args: runChecker(module.check, name, args)
+
+
+def forget(name):
+  """Drop cached results and perf data of a check, e.g. when its code changes."""
+  for key in RESULT_CACHE.keys():
+    if key[0] == name:
+      del RESULT_CACHE[key]
+  METRICS.forget(name)
+
+
+def listChecks():
+  """Get the names of all checks in the check directory."""
+  names = set()
+  for filename in os.listdir(os.path.join(os.path.dirname(__file__), OPTIONS.checkdir)):
+    match = CHECK_FILE_RE.match(filename)
+    if match:
+      names.add(match.group(1))
+  return names
+
+
+def scanChecks():
+  """Reload changed check modules, off the request path, and drop checks whose files were removed."""
+  global KNOWN_CHECKS # pylint: disable=W0603
+  found = listChecks()
+  for name in found:
+    if name in CHECK_CACHE and os.path.getmtime(checkFilename(name)) != CHECK_MTIMES.get(name):
+      logging.info('Reloading changed check %s', name)
+      loadCheck(name, background=True)
+      forget(name)
+
+  for name in set(CHECK_CACHE) - found:
+    logging.info('Dropping removed check %s', name)
+    CHECK_CACHE.pop(name, None)
+    LOAD_ERRORS.pop(name, None)
+    forget(name)
+  KNOWN_CHECKS = found
+
+
+def watchChecks(interval):
+  """Poll the check directory for changes forever."""
+  while True:
+    try:
+      scanChecks()
+    except Exception: # ok to catch generic error # pylint: disable=W0703
+      logging.exception('Scanning for check changes failed')
+    eventlet.sleep(interval)
+
+
+def preloadCheck(name, warmup):
+  """Import a check, and run it once with its WARMUP_ARGS if warmup is set and the check defines them."""
+  start = time.time()
+  try:
+    loadCheck(name, background=True)
+  except Exception: # ok to catch generic error # pylint: disable=W0703
+    return
+  IMPORT_TIMES[name] = time.time() - start
+  logging.info('Imported check %s in %.3f seconds', name, IMPORT_TIMES[name])
+
+  warmupArgs = getattr(CHECK_CACHE[name], 'WARMUP_ARGS', None)
+  if warmup and warmupArgs is not None:
+    args = ['check_%s' % name]
+    args.extend(warmupArgs)
+    start = time.time()
+    runWithDeadline(name, args, checker(name))
+    logging.info('Warmed up check %s in %.3f seconds', name, time.time() - start)
+
+
+def preloadChecks(warmup):
+  """Import all checks concurrently, then mark the server ready."""
+  global READY # pylint: disable=W0603
+  pool = eventlet.GreenPool()
+  for name in listChecks():
+    pool.spawn_n(preloadCheck, name, warmup)
+  pool.waitall()
+  READY = True
+  logging.info('Preloaded %d checks', len(IMPORT_TIMES))
+
+
+def cacheTtl(name):
+  """Seconds to cache results of the given check. Checks can override the default with CACHE_TTL."""
+  return getattr(CHECK_CACHE[name], 'CACHE_TTL', OPTIONS.cachettl)
+
+
+def checkTimeout(name):
+  """Seconds a check may run before it is abandoned. Checks can override the default with TIMEOUT."""
+  return getattr(CHECK_CACHE[name], 'TIMEOUT', OPTIONS.timeout) or None
+
+
+def runTimed(fun, args, timings):
+  """Run fun(args) in a worker thread, recording when it started and profiling it if timings asks for it."""
+  timings['started'] = time.time()
+  if timings.get('profile'):
+    profiler = timings['profile'] = cProfile.Profile()
+    return profiler.runcall(fun, args)
+  return fun(args)
+
+
+def runWithDeadline(name, args, checkFun, timings = None, finished = None):
+  """Run a check in the thread pool, in a worker process if it is ISOLATED, or in this green thread if it is GREEN,
+  giving up at its deadline.  Calls finished() once the check no longer holds a thread, which for a thread that timed
+  out is after this returns."""
+  timings = {} if timings is None else timings
+  timeout = checkTimeout(name)
+  handedOff = False
+  try:
+    if PROCESS_POOL and getattr(CHECK_CACHE[name], 'ISOLATED', False):
+      timings['started'] = time.time()
+      try:
+        return PROCESS_POOL.execute(timeout, checkFilename(name), name, args)
+      except WorkerTimeout:
+        return TIMED_OUT
+      except WorkerDied:
+        return WORKER_DIED
+      except WorkerError, e:
+        return parseResponse('UNKNOWN: %s' % e)
+
+    # A thread keeps running after a timeout, but the request returns on time.  A green check is interrupted.
+    timer = eventlet.Timeout(timeout)
+    try:
+      if getattr(CHECK_CACHE[name], 'GREEN', False):
+        # Green checks yield to the hub while they wait on the network, so they run here instead of holding a thread.
+        # The profiler would see every other green thread too, so they are not profiled.
+        timings['profile'] = False
+        return runTimed(checkFun, args, timings)
+      thread = eventlet.spawn(tpool.execute, runTimed, checkFun, args, timings)
+      if finished:
+        thread.link(lambda _: finished())
+        handedOff = True
+      return thread.wait()
+    except eventlet.Timeout, e:
+      if e is not timer:
+        raise
+      logging.warning('Check %s %r timed out after %s seconds', name, args[1:], timeout)
+      return TIMED_OUT
+    finally:
+      timer.cancel()
+  finally:
+    if finished and not handedOff:
+      finished()
+
+
+def lanesFor(name):
+  """Get the admission lanes a check must enter before it runs."""
+  module = CHECK_CACHE[name]
+  lanes = []
+  limit = getattr(module, 'MAX_CONCURRENCY', OPTIONS.checkconcurrency)
+  if limit:
+    if name not in CHECK_LANES or CHECK_LANES[name].limit != limit:
+      CHECK_LANES[name] = Lane(limit, OPTIONS.maxqueue, OPTIONS.maxqueuetime)
+    lanes.append(CHECK_LANES[name])
+  shared = LANES.get('fast' if getattr(module, 'FAST', False) else 'default')
+  if shared:
+    lanes.append(shared)
+  return lanes
+
+
+def runAdmitted(name, args, checkFun, timings):
+  """Run a check once its concurrency limits allow, or return OVERLOADED if it can't get in soon enough.  The check
+  keeps its place in the lanes until its thread is free again, even after it timed out."""
+  entered = []
+
+  def leave():
+    """Frees the check's place in every lane it entered."""
+    for lane in entered:
+      lane.release()
+
+  for lane in lanesFor(name):
+    if not lane.acquire():
+      leave()
+      logging.warning('Rejected check %s %r: overloaded', name, args[1:])
+      return OVERLOADED
+    entered.append(lane)
+  return runWithDeadline(name, args, checkFun, timings, leave)
+
+
+def graphiteName(part):
+  """Encode part of a graphite metric name as UTF-8, with whitespace, which ends the name, replaced."""
+  if isinstance(part, unicode):
+    part = part.encode('utf-8')
+  return re.sub(r'\s+', '_', part)
+
+
+def reportGraphite(name, args, perfdata):
+  """Queue numeric perf data from a check's result for graphite."""
+  prefix = '.'.join([graphiteName(part) for part in ['checkserver', name] + args[1:]])
+  now = time.time()
+  for k, v in perfdata.iteritems():
+    if isinstance(v, (int, long, float)):
+      GRAPHITE.enqueue('%s.%s' % (prefix, graphiteName(k)), v, now)
+
+
+def shouldProfile(name):
+  """Whether to profile this run of a check."""
+  if name not in PROFILE_RATES:
+    return False
+  PROFILE_COUNTS[name] += 1
+  return (PROFILE_COUNTS[name] - 1) % PROFILE_RATES[name] == 0
+
+
+def recordTimings(name, args, timings, finished):
+  """Record the phase durations of a check run, log it if it was slow, and keep its profile if it has one."""
+  started = timings.get('started', finished)
+  queueTime = started - timings['submitted']
+  executeTime = finished - started
+  METRICS.recordPhases(name, queue=queueTime, execute=executeTime)
+  if OPTIONS.slowthreshold and queueTime + executeTime > OPTIONS.slowthreshold:
+    logging.warning('Slow check %s %r: queued %.3fs, ran %.3fs', name, args[1:], queueTime, executeTime)
+
+  profiler = timings.get('profile')
+  if isinstance(profiler, cProfile.Profile):
+    if name in PROFILES:
+      PROFILES[name].add(profiler)
+    else:
+      PROFILES[name] = pstats.Stats(profiler)
+
+
+def execute(name, args, checkFun):
+  """Run a check, answering from the result cache or an identical in-flight execution when possible."""
+  key = (name, tuple(args))
+  ttl = cacheTtl(name)
+  if ttl > 0:
+    cached = RESULT_CACHE.get(key)
+    if cached and cached[0] > time.time():
+      CACHE_STATS['hit'] += 1
+      return cached[1]
+
+  if key in IN_FLIGHT:
+    CACHE_STATS['coalesced'] += 1
+    return IN_FLIGHT[key].wait()
+
+  CACHE_STATS['miss'] += 1
+  done = event.Event()
+  IN_FLIGHT[key] = done
+  start = time.time()
+  timings = {'submitted': start, 'profile': shouldProfile(name)}
+  try:
+    result = runAdmitted(name, args, checkFun, timings)
+  except Exception, e:
+    METRICS.record(name, args, time.time() - start, UNKNOWN, None, error=True)
+    done.send_exception(e)
+    raise
+  finally:
+    del IN_FLIGHT[key]
+  finished = time.time()
+  duration = finished - start
+
+  if result is OVERLOADED:
+    done.send(result)
+    return result
+
+  if ttl > 0:
+    RESULT_CACHE[key] = (time.time() + ttl, result)
+  done.send(result)
+
+  perfdata = result.values()
+  recordTimings(name, args, timings, finished)
+  error = result is TIMED_OUT or result.text.startswith(CHECKER_EXCEPTION)
+  METRICS.record(name, args, duration, result.status, perfdata, error)
+  if GRAPHITE and perfdata:
+    reportGraphite(name, args, perfdata)
+  return result
+
+
+def latestResult(key):
+  """Get the latest result of a scheduled check, None if there isn't one yet, or UNKNOWN if it is too old."""
+  if key not in LATEST:
+    return None
+  finished, result = LATEST[key]
+  age = time.time() - finished
+  if age > SCHEDULE[key]['maxAge']:
+    return parseResponse('UNKNOWN: Latest scheduled result is %d seconds old' % age)
+  return result
+
+
+def respond(name, args, checkFun):
+  """Answer a check request, from the latest scheduled result if there is one."""
+  if (name, tuple(args)) in SCHEDULE:
+    result = latestResult((name, tuple(args)))
+    if result is not None:
+      return result
+  return execute(name, args, checkFun)
+
+
+def runScheduled(entry, limit):
+  """Run a scheduled check forever, storing each result in LATEST."""
+  name = entry['name']
+  args = ['check_%s' % name]
+  args.extend(entry['args'])
+  key = (name, tuple(args))
+
+  # Spread the first runs over the whole interval so checks don't all start together.
+  eventlet.sleep(random.uniform(0, entry['interval']))
+  while True:
+    with limit:
+      try:
+        result = execute(name, args, checker(name))
+      except KeyError:
+        result = parseResponse('UNKNOWN: No such check: %s' % name)
+      except Exception, e: # ok to catch generic error # pylint: disable=W0703
+        logging.exception('Scheduled check %s failed', name)
+        result = parseResponse('UNKNOWN: %s' % e)
+    LATEST[key] = (time.time(), result)
+    eventlet.sleep(max(0, entry['interval'] + random.uniform(-entry['jitter'], entry['jitter'])))
+
+
+def startScheduler(filename, concurrency):
+  """Start running the checks listed in a JSON schedule file.
+
+  The file holds a list of {"name": ..., "args": [...], "interval": seconds} entries, optionally with "jitter" (seconds
+  to randomly vary each interval by, default a tenth of the interval) and "maxAge" (seconds after which the latest
+  result is reported as UNKNOWN, default three intervals).
+  """
+  with open(filename) as f:
+    entries = json.load(f)
+
+  limit = semaphore.Semaphore(concurrency)
+  for entry in entries:
+    entry.setdefault('args', [])
+    entry.setdefault('jitter', entry['interval'] / 10.0)
+    entry.setdefault('maxAge', entry['interval'] * 3)
+    args = ['check_%s' % entry['name']]
+    args.extend(entry['args'])
+    SCHEDULE[(entry['name'], tuple(args))] = entry
+    eventlet.spawn_n(runScheduled, entry, limit)
+
+
+def laneStats():
+  """Get the state of each admission lane."""
+  stats = dict((name, lane.stats()) for name, lane in LANES.items())
+  stats.update(('check.%s' % name, lane.stats()) for name, lane in CHECK_LANES.items())
+  return stats
 
 
 @APP.route('/')
 def root():
   """Root request handler."""
-  return jsonify(STATS)
+  return jsonify(checks=STATS, cache=CACHE_STATS, graphite=GRAPHITE.stats if GRAPHITE else {}, loadErrors=LOAD_ERRORS,
+                 importTimes=IMPORT_TIMES, admission=laneStats())
+
+
+@APP.route('/ready')
+def ready():
+  """Readiness check: 503 until startup preloading and warm-up are finished."""
+  if READY:
+    return 'ready'
+  return make_response('not ready', 503)
+
+
+@APP.route('/metrics')
+def metrics():
+  """Latest perf data and execution stats in OpenMetrics text format."""
+  resp = make_response(METRICS.render(STATS, CACHE_STATS, laneStats()))
+  resp.headers['Content-Type'] = CONTENT_TYPE
+  return resp
+
+
+@APP.route('/timings')
+def timingStats():
+  """Percentiles of queue, execution and parse time for each check over the last few minutes."""
+  return jsonify(METRICS.phasePercentiles())
+
+
+@APP.route('/profile/<name>')
+def profile(name):
+  """Download the accumulated profile of a check, in pstats format, or as text with ?format=text."""
+  if name not in PROFILES:
+    return abort(404)
+  stats = PROFILES[name]
+  if request.args.get('format') == 'text':
+    out = StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(100)
+    resp = make_response(out.getvalue())
+    resp.headers['Content-Type'] = 'text/plain; charset=UTF-8'
+    return resp
+
+  resp = make_response(marshal.dumps(stats.stats))
+  resp.headers['Content-Type'] = 'application/octet-stream'
+  resp.headers['Content-Disposition'] = 'attachment; filename=check_%s.prof' % name
+  return resp
 
 
 @APP.route('/update/<name>')
@@ -76,6 +568,7 @@ def update(name):
   """Reload a check module."""
   if name in CHECK_CACHE:
     del CHECK_CACHE[name]
+    forget(name)
     return "Reloaded"
   else:
     abort(404)
@@ -93,31 +586,66 @@ def check(name):
   args = request.args.getlist('arg')
   args.insert(0, 'check_%s' % name)
 
-  output = tpool.execute(checkFun, args)
-  if GRAPHITE:
-    try:
-      parsed = nagios.parseResponse(output)
-    except Exception, e: # ok to catch generic error # pylint: disable=W0703
-      print 'During %s: %r' % (name, e)
-      parsed = None
-
-    if parsed and parsed[2]:
-      for k, v in parsed[2].iteritems():
-        if isinstance(v, (int, long, float)):
-          parts = ['checkserver', name]
-          parts.extend(args[1:])
-          parts.append(k)
-          GRAPHITE.enqueue('.'.join(parts), v)
-      if not GRAPHITE.isAlive():
-        GRAPHITE.start()
-
-  resp = make_response(output)
+  result = respond(name, args, checkFun)
   STATS[name] += 1
 
+  if request.args.get('format') == 'json':
+    return jsonify(result.toJson())
+
+  resp = make_response(result.text)
   resp.headers['Content-Type'] = 'text/plain; charset=UTF-8'
   return resp
 
 
+def validBatchEntry(entry):
+  """Whether a batch entry is a dict with a string name and, optionally, a list of string args."""
+  if not isinstance(entry, dict) or not isinstance(entry.get('name'), basestring):
+    return False
+  args = entry.get('args', [])
+  return isinstance(args, list) and all(isinstance(arg, basestring) for arg in args)
+
+
+def runBatchEntry(idx, entry, results):
+  """Run one entry of a batch request, putting exactly one result on the results queue."""
+  name = entry.get('name')
+  args = ['check_%s' % name]
+  try:
+    args.extend(entry.get('args', []))
+    result = respond(name, args, checker(name))
+    STATS[name] += 1
+  except KeyError:
+    result = parseResponse('UNKNOWN: No such check: %s' % name)
+  except Exception, e: # ok to catch generic error # pylint: disable=W0703
+    logging.exception('Batch entry %s failed', name)
+    result = parseResponse('UNKNOWN: %s' % e)
+  results.put({'id': idx, 'name': name, 'args': args[1:], 'output': result.text, 'status': result.status})
+
+
+@APP.route('/batch', methods=['POST'])
+def batch():
+  """Run a list of {"name": ..., "args": [...]} checks concurrently.
+
+  Streams back one JSON result per line, in the order the checks finish.
+  """
+  try:
+    entries = json.loads(request.data)
+  except ValueError:
+    return abort(400)
+  if not isinstance(entries, list) or not all(validBatchEntry(entry) for entry in entries):
+    return abort(400)
+
+  results = Queue()
+  for idx, entry in enumerate(entries):
+    eventlet.spawn_n(runBatchEntry, idx, entry, results)
+
+  def stream():
+    """Yield results as they complete."""
+    for _ in xrange(len(entries)):
+      yield json.dumps(results.get()) + '\n'
+
+  return Response(stream(), mimetype='application/x-json-stream')
+
+
 def main():
   """Run the server."""
   global OPTIONS # pylint: disable=W0603
@@ -128,22 +656,95 @@ def main():
                     help="logging level", default='info')
   parser.add_option("-g", "--graphite", dest="graphite", metavar="GRAPHITE_HOST",
                     help="graphite host, specify as host:post", default='')
+  parser.add_option("--graphite-interval", dest="graphiteinterval", metavar="SECONDS",
+                    help="seconds between graphite flushes", default=5, type="float")
+  parser.add_option("--graphite-batch", dest="graphitebatch", metavar="COUNT",
+                    help="maximum metrics per graphite write", default=500, type="int")
+  parser.add_option("--graphite-buffer", dest="graphitebuffer", metavar="COUNT",
+                    help="maximum metrics waiting to be sent before new ones are dropped", default=100000, type="int")
+  parser.add_option("--graphite-protocol", dest="graphiteprotocol", metavar="PROTOCOL",
+                    help="graphite protocol, plaintext or pickle", default='plaintext', choices=['plaintext', 'pickle'])
   parser.add_option("-p", "--port", dest="port", metavar="PORT",
                     help="port to listen on", default=8111, type="int")
+  parser.add_option("-c", "--cache-ttl", dest="cachettl", metavar="SECONDS",
+                    help="default seconds to cache check results", default=0, type="float")
+  parser.add_option("-t", "--timeout", dest="timeout", metavar="SECONDS",
+                    help="default seconds a check may run before returning UNKNOWN", default=0, type="float")
+  parser.add_option("-w", "--processes", dest="processes", metavar="COUNT",
+                    help="number of worker processes for checks that set ISOLATED", default=0, type="int")
+  parser.add_option("--concurrency", dest="concurrency", metavar="COUNT",
+                    help="maximum checks running at once, 0 for no limit", default=0, type="int")
+  parser.add_option("--fast-concurrency", dest="fastconcurrency", metavar="COUNT",
+                    help="maximum checks that set FAST running at once, 0 for no limit", default=0, type="int")
+  parser.add_option("--check-concurrency", dest="checkconcurrency", metavar="COUNT",
+                    help="default maximum runs of any one check at once, 0 for no limit", default=0, type="int")
+  parser.add_option("--threads", dest="threads", metavar="COUNT",
+                    help="threads running checks, by default 20 or enough for the concurrency limits", default=0, type="int")
+  parser.add_option("--max-queue", dest="maxqueue", metavar="COUNT",
+                    help="maximum checks waiting for each concurrency limit", default=100, type="int")
+  parser.add_option("--max-queue-time", dest="maxqueuetime", metavar="SECONDS",
+                    help="maximum seconds a check waits for a concurrency limit", default=10, type="float")
+  parser.add_option("--slow-threshold", dest="slowthreshold", metavar="SECONDS",
+                    help="log check runs that take longer than SECONDS", default=0, type="float")
+  parser.add_option("--profile", dest="profile", metavar="NAME:N", action="append", default=[],
+                    help="profile one in every N runs of check NAME, may be repeated")
+  parser.add_option("--watch", dest="watch", metavar="SECONDS",
+                    help="poll the check directory every SECONDS and reload changed checks", default=0, type="float")
+  parser.add_option("--preload", dest="preload", action="store_true", default=False,
+                    help="import every check at startup")
+  parser.add_option("--warmup", dest="warmup", action="store_true", default=False,
+                    help="with --preload, run each check that defines WARMUP_ARGS once at startup")
+  parser.add_option("-s", "--schedule", dest="schedule", metavar="FILE",
+                    help="JSON file listing checks to run in the background", default='')
+  parser.add_option("--schedule-concurrency", dest="scheduleconcurrency", metavar="COUNT",
+                    help="maximum number of scheduled checks running at once", default=10, type="int")
   OPTIONS = parser.parse_args()[0]
 
+  # Every admitted check shares eventlet's thread pool, so it needs a thread for each check the lanes let
+  # in; otherwise slow checks holding all the threads would queue FAST checks behind them anyway.
+  if OPTIONS.fastconcurrency and not OPTIONS.concurrency:
+    parser.error('--fast-concurrency needs --concurrency, or slow checks can take every thread')
+  needed = OPTIONS.concurrency + OPTIONS.fastconcurrency + RESERVED_THREADS
+  if OPTIONS.threads and OPTIONS.concurrency and OPTIONS.threads < needed:
+    parser.error('--threads must be at least %d to run every check the concurrency limits admit' % needed)
+  tpool.set_num_threads(OPTIONS.threads or max(20, needed))
+
   levelName = {'debug': logging.DEBUG, 'info': logging.INFO, 'warn': logging.WARN, 'error': logging.ERROR}
   logging.basicConfig(level=levelName.get(OPTIONS.loglevel.lower(), logging.WARN))
 
   if OPTIONS.graphite:
-    from greplin.scales import util
-
     host, port = OPTIONS.graphite.split(':')
 
     global GRAPHITE # pylint: disable=W0603
-    GRAPHITE = util.GraphiteReporter(host, int(port))
+    GRAPHITE = GraphiteReporter(host, int(port), OPTIONS.graphiteinterval, OPTIONS.graphitebatch,
+                                OPTIONS.graphitebuffer, OPTIONS.graphiteprotocol)
     GRAPHITE.start()
 
+  for spec in OPTIONS.profile:
+    name, rate = spec.rsplit(':', 1)
+    PROFILE_RATES[name] = int(rate)
+
+  if OPTIONS.concurrency:
+    LANES['default'] = Lane(OPTIONS.concurrency, OPTIONS.maxqueue, OPTIONS.maxqueuetime)
+  if OPTIONS.fastconcurrency:
+    LANES['fast'] = Lane(OPTIONS.fastconcurrency, OPTIONS.maxqueue, OPTIONS.maxqueuetime)
+
+  if OPTIONS.processes:
+    global PROCESS_POOL # pylint: disable=W0603
+    PROCESS_POOL = ProcessPool(OPTIONS.processes, runIsolated)
+
+  if OPTIONS.preload:
+    global READY # pylint: disable=W0603
+    READY = False
+    eventlet.spawn_n(preloadChecks, OPTIONS.warmup)
+
+  if OPTIONS.watch:
+    scanChecks()
+    eventlet.spawn_n(watchChecks, OPTIONS.watch)
+
+  if OPTIONS.schedule:
+    startScheduler(OPTIONS.schedule, OPTIONS.scheduleconcurrency)
+
   wsgi.server(eventlet.listen(('', int(OPTIONS.port))), APP)
 
 
@@ -23,6 +23,12 @@ params    $HOSTNAME$
 
 from greplin.nagios import parseArgs, Maximum, ResponseBuilder
 
+# Arguments for the startup warm-up run with --preload --warmup.
+WARMUP_ARGS = ['localhost']
+
+# Run in the fast lane, separate from slow checks, when --fast-concurrency is set.
+FAST = True
+
 
 def check(argv):
   """Runs the check."""
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Status
+
+nagios config:
+use       regular-service
+params    $HOSTNAME$
+"""
+
+
+from greplin.nagios import parseArgs, parseJson, greenWgetWithTimeout, Maximum, ResponseBuilder
+
+# Run on checkserver's event loop instead of in a thread.
+GREEN = True
+
+
+def check(argv):
+  """Runs the check."""
+  args = parseArgs('check_green.py', ('NAME', str), argv=argv)
+  elapsed, body = greenWgetWithTimeout(args['NAME'], 8111, '/', 5)
+  data = parseJson(body)
+
+  (ResponseBuilder()
+      .addValue('checks', len(data.get('checks', {})))
+      .addRule('latency', Maximum(0.5, 1, 's'), elapsed)).finish()
+
+
+if __name__ == '__main__':
+  import sys
+  check(sys.argv)
@@ -0,0 +1,129 @@
+# Copyright 2012 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-forked worker processes that run checks in isolation from the server."""
+
+import logging
+import multiprocessing
+import time
+
+from eventlet import tpool
+from eventlet.queue import Queue, Empty
+
+
+
+class WorkerTimeout(Exception):
+  """Raised when a worker does not finish before its deadline."""
+
+
+
+class WorkerError(Exception):
+  """Raised when the call in a worker raised an exception."""
+
+
+
+class WorkerDied(WorkerError):
+  """Raised when a worker process exits in the middle of a call."""
+
+
+
+def serve(target, conn):
+  """Worker process main loop: call target with each argument tuple received and send back whether it succeeded and
+  the result, or a description of the exception it raised."""
+  while True:
+    try:
+      args = conn.recv()
+    except EOFError:
+      return
+    try:
+      response = (True, target(*args))
+    except Exception, e: # ok to catch generic error # pylint: disable=W0703
+      logging.exception('Worker call failed')
+      response = (False, '%s: %s' % (e.__class__.__name__, e))
+    conn.send(response)
+
+
+
+class WorkerProcess(object):
+  """A forked process that runs calls sent to it over a pipe."""
+
+  def __init__(self, target):
+    self.target = target
+    self.conn = None
+    self.process = None
+    self.start()
+
+
+  def start(self):
+    """Forks the worker process."""
+    self.conn, childConn = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(target=serve, args=(self.target, childConn))
+    self.process.daemon = True
+    self.process.start()
+    childConn.close()
+
+
+  def restart(self):
+    """Kills the worker process and forks a new one."""
+    self.process.terminate()
+    self.process.join()
+    self.conn.close()
+    self.start()
+
+
+  def call(self, timeout, args):
+    """Runs target(*args) in the worker, killing and replacing the worker if it takes longer than timeout.  Raises
+    WorkerError if target raised, and WorkerDied if the worker exited."""
+    try:
+      self.conn.send(args)
+      if self.conn.poll(timeout):
+        succeeded, result = self.conn.recv()
+        if not succeeded:
+          raise WorkerError(result)
+        return result
+    except (EOFError, IOError):
+      logging.warning('Worker %d died, restarting', self.process.pid)
+      self.restart()
+      raise WorkerDied()
+
+    logging.warning('Worker %d timed out after %s seconds, restarting', self.process.pid, timeout)
+    self.restart()
+    raise WorkerTimeout()
+
+
+
+class ProcessPool(object):
+  """A fixed size pool of worker processes."""
+
+  def __init__(self, size, target):
+    self._idle = Queue()
+    for _ in range(size):
+      self._idle.put(WorkerProcess(target))
+
+
+  def execute(self, timeout, *args):
+    """Runs target(*args) in an idle worker. Raises WorkerTimeout if timeout seconds pass first, and WorkerError if
+    the call fails."""
+    start = time.time()
+    try:
+      worker = self._idle.get(timeout=timeout)
+    except Empty:
+      raise WorkerTimeout()
+
+    if timeout is not None:
+      timeout = max(0, timeout - (time.time() - start))
+    try:
+      return tpool.execute(worker.call, timeout, args)
+    finally:
+      self._idle.put(worker)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-nagios-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures building and generating the config for a synthetic fleet.
+
+Usage: generate_benchmark.py [--templates] [--processes=N] [HOSTS [SERVICES_PER_HOST]], 100000 hosts with 10
+services each by default.  With --templates, common properties are extracted into templates before generating.  With
+--processes, the fleet is built in N worker processes and merged.
+"""
+
+import resource
+import sys
+import time
+
+from greplin import nagiosconf
+
+
+SERVICES = ('ping', 'ssh', 'disk', 'load', 'memory', 'swap', 'ntp', 'procs', 'users', 'http')
+
+
+class NullOutput(object):
+  """Counts what is written without keeping it."""
+
+  def __init__(self):
+    self.size = 0
+    self.writes = 0
+
+
+  def write(self, text):
+    """Counts text."""
+    self.size += len(text)
+    self.writes += 1
+
+
+def build(hosts, servicesPerHost):
+  """Adds the fleet to the global bags."""
+  buildSlice((0, hosts, servicesPerHost))
+
+
+def buildSlice(hostRange):
+  """Adds hosts first to last - 1 of the fleet to the global bags."""
+  first, last, servicesPerHost = hostRange
+  for i in xrange(first, last):
+    host = nagiosconf.HOSTS.create('host%06d.example.com' % i)
+    host.props['address'] = '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255)
+    host.props['use'] = 'generic-host'
+    host.addGroup('rack%03d' % (i % 500))
+    host.addGroup('role%02d' % (i % 20))
+    for svc in SERVICES[:servicesPerHost]:
+      service = nagiosconf.SERVICES.create('%s %s' % (host.name, svc))
+      service.props['host_name'] = host.name
+      service.props['service_description'] = svc
+      service.props['check_command'] = 'check_nrpe!check_%s' % svc
+      service.props['use'] = 'generic-service'
+
+
+def main():
+  """Run the benchmark."""
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  hosts = int(args[0]) if args else 100000
+  servicesPerHost = int(args[1]) if len(args) > 1 else 10
+  processes = [int(arg.split('=')[1]) for arg in sys.argv[1:] if arg.startswith('--processes=')]
+
+  start = time.time()
+  if processes:
+    step = -(-hosts // processes[0])
+    nagiosconf.buildParallel(buildSlice, [(first, min(hosts, first + step), servicesPerHost)
+                                          for first in xrange(0, hosts, step)], processes[0])
+  else:
+    build(hosts, servicesPerHost)
+  if '--templates' in sys.argv:
+    nagiosconf.extractTemplates(nagiosconf.HOSTS, nagiosconf.HOSTTEMPLATES, minProps=1)
+    nagiosconf.extractTemplates(nagiosconf.SERVICES, nagiosconf.SERVICETEMPLATES)
+  built = time.time()
+  out = NullOutput()
+  nagiosconf.generate(out)
+  generated = time.time()
+
+  objects = sum([len(bag.bag) for bag in (nagiosconf.HOSTS, nagiosconf.SERVICES, nagiosconf.HOSTGROUPS,
+                                          nagiosconf.HOSTTEMPLATES, nagiosconf.SERVICETEMPLATES)])
+  sys.stdout.write('%d objects: built in %.2fs, generated %.1f MB in %d writes in %.2fs (%.0f objects/s), '
+                   'peak RSS %d MB\n' % (objects, built - start, out.size / 1e6, out.writes, generated - built,
+                                         objects / (generated - built),
+                                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+
+if __name__ == '__main__':
+  main()
@@ -15,7 +15,84 @@
 
 """Configuration generator for Nagios."""
 
+import hashlib
+import json
+import multiprocessing
+import operator
+import os
+import re
 import sys
+from collections import defaultdict
+
+
+
+class Props(dict):
+  """An object's properties, with the bag and name of the object they belong to
+  """
+
+  __slots__ = ('bag', 'name')
+
+
+  def __reduce__(self):
+    return (self.__class__, (dict(self),), (None, {'bag': self.bag, 'name': self.name}))
+
+
+
+class IndexedProps(Props):
+  """The properties of an object in an indexed bag - keeps the bag's indexes up to date as they change.  Bags switch
+  their objects' props to this class when they are first indexed, so building unindexed bags stays fast.
+  """
+
+  __slots__ = ()
+
+
+  def __setitem__(self, key, value):
+    bag = self.bag
+    if key in bag.indexes:
+      owner = bag.bag[self.name]
+      bag.unindex(owner, key)
+      dict.__setitem__(self, key, value)
+      bag.reindex(owner, key)
+    else:
+      dict.__setitem__(self, key, value)
+
+
+  def __delitem__(self, key):
+    bag = self.bag
+    if key in bag.indexes:
+      bag.unindex(bag.bag[self.name], key)
+    dict.__delitem__(self, key)
+
+
+  def update(self, *args, **kw):
+    for key, value in dict(*args, **kw).iteritems():
+      self[key] = value
+
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return dict.__getitem__(self, key)
+
+
+  def pop(self, key, *default):
+    if key in self:
+      value = dict.__getitem__(self, key)
+      del self[key]
+      return value
+    return dict.pop(self, key, *default)
+
+
+  def popitem(self):
+    if not self:
+      raise KeyError('popitem(): dictionary is empty')
+    key = next(iter(self))
+    return key, self.pop(key)
+
+
+  def clear(self):
+    for key in self.keys():
+      del self[key]
 
 
 
@@ -23,24 +100,165 @@ class NagObj(object):
   """base nagios object
   """
 
+  __slots__ = ('name', '_props', 'meta', 'template', 'bag')
+
+
   def __init__(self, name):
     object.__init__(self)
     self.name = name
-    self.props = {}
+    self.bag = None
+    props = self._props = Props()
+    props.bag = None
+    props.name = name
     self.meta = {}
+    self.template = None
 
 
-  def __repr__(self):
+  def _setProps(self, props):
+    """Replace the properties with a copy of the given dict, keeping the bag's indexes up to date
+    """
+    bag = self.bag
+    indexed = bag is not None and bag.indexes
+    if indexed:
+      for key in bag.indexes:
+        bag.unindex(self, key)
+    copy = (IndexedProps if indexed else Props)(props)
+    copy.bag = bag
+    copy.name = self.name
+    self._props = copy
+    if indexed:
+      for key in bag.indexes:
+        bag.reindex(self, key)
+
+
+  # attrgetter keeps reads, by far the most common use, as fast as a plain attribute.
+  props = property(operator.attrgetter('_props'), _setProps)
+
+
+  def use(self, template):
+    """Inherit properties from the given template.  props then only needs to hold this object's overrides.
+    """
+    if self.bag is not None:
+      if self.template is not None:
+        self.bag.users[self.template].discard(self)
+      self.bag.users[template].add(self)
+    self.template = template
+    return self
+
+
+  def lookup(self, key, default=None):
+    """Get a property, falling back to the templates this object inherits from
+    """
+    obj = self
+    while obj is not None:
+      if key in obj.props:
+        return obj.props[key]
+      obj = obj.template
+    return default
+
+
+  def effectiveProps(self):
+    """All properties including inherited ones, as Nagios will see them
+    """
+    if self.template is None:
+      return dict(self.props)
+    props = self.template.effectiveProps()
+    props.update(self.props)
+    return props
+
+
+  def derivedFields(self):
+    """Properties derived from the object's state rather than stored in props, or None
+    """
+    if self.template is None:
+      return None
+    use = self.props.get('use')
+    # Nagios gives earlier templates precedence, and the template holds properties that used to be the object's own.
+    return {'use': '%s,%s' % (self.template.name, use) if use else self.template.name}
+
+
+  def fields(self):
+    """The properties to render, including any derived from the object's state.  Never modifies props.
+    """
+    derived = self.derivedFields()
+    if not derived:
+      return self.props
+    props = dict(self.props)
+    props.update(derived)
+    return props
+
+
+  def render(self):
+    """Render this object as a define block, with properties sorted by name
+    """
     assert self.typeName != None
-    if not self.props:
+    props = self.fields()
+    if not props:
       return "# skipped define for empty %s %s\n" % (self.typeName, self.name)
 
-    ret = ["define %s {" % self.typeName ]
-    mlen = max([ len(k) for k in self.props.keys()]) + 2
-    for k, v in self.props.items():
-      ret.append("  %s%s%s" % (k, ' ' * (mlen-len(k)), v))
-    ret.append("}")
-    return "\n".join(ret)
+    mlen = max([len(k) for k in props]) + 2
+    lines = ["  %s%s" % (k.ljust(mlen), v) for k, v in sorted(props.iteritems())]
+    return "define %s {\n%s\n}" % (self.typeName, "\n".join(lines))
+
+
+  def __repr__(self):
+    return self.render()
+
+
+
+class ChunkedWriter(object):
+  """Collects rendered definitions and writes them to the underlying stream in large chunks
+  """
+
+  def __init__(self, out, chunkSize = 1 << 16):
+    object.__init__(self)
+    self.out = out
+    self.chunkSize = chunkSize
+    self.size = 0
+    self.pending = []
+    self.pendingSize = 0
+
+
+  def write(self, text):
+    """Queue text to be written
+    """
+    self.pending.append(text)
+    self.pendingSize += len(text)
+    if self.pendingSize >= self.chunkSize:
+      self.flush()
+
+
+  def flush(self):
+    """Write everything queued so far
+    """
+    if self.pending:
+      self.writeChunk(''.join(self.pending))
+      self.size += self.pendingSize
+      self.pending = []
+      self.pendingSize = 0
+
+
+  def writeChunk(self, chunk):
+    """Write a chunk to the underlying stream
+    """
+    self.out.write(chunk)
+
+
+
+class HashingWriter(ChunkedWriter):
+  """A ChunkedWriter that keeps a SHA-1 hash of everything written
+  """
+
+  def __init__(self, out, chunkSize = 1 << 16):
+    ChunkedWriter.__init__(self, out, chunkSize)
+    self.hash = hashlib.sha1()
+
+
+  def writeChunk(self, chunk):
+    """Hash and write a chunk
+    """
+    self.hash.update(chunk)
+    self.out.write(chunk)
 
 
 
@@ -53,6 +271,10 @@ class NagBag(object):
     object.__init__(self)
     self.klass = klass
     self.bag = {}
+    # Maps an indexed property name to {value: set of objects with that value}
+    self.indexes = {}
+    # Maps a template to the set of objects in this bag that use it
+    self.users = defaultdict(set)
 
 
   def create(self, name):
@@ -61,10 +283,24 @@ class NagBag(object):
     assert not name in self.bag
 
     inst = self.klass(name)
+    inst.bag = self
+    inst.props.bag = self
+    if self.indexes:
+      inst.props.__class__ = IndexedProps
     self.bag[name] = inst
     return inst
 
 
+  def createMany(self, names):
+    """Create a new object for each of the given names, returning them in the same order
+    """
+    names = list(names)
+    assert len(set(names)) == len(names)
+    assert not [name for name in names if name in self.bag]
+
+    return [self.create(name) for name in names]
+
+
   def get(self, name):
     """Get a object by name
     """
@@ -84,11 +320,59 @@ class NagBag(object):
     return self.create(name)
 
 
+  def indexBy(self, key):
+    """Index the objects in this bag by the value of the given property, kept up to date from then on
+    """
+    if key not in self.indexes:
+      if not self.indexes:
+        for obj in self.bag.itervalues():
+          obj.props.__class__ = IndexedProps
+      index = self.indexes[key] = {}
+      for obj in self.bag.itervalues():
+        if key in obj.props:
+          index.setdefault(obj.props[key], set()).add(obj)
+    return self.indexes[key]
+
+
+  def unindex(self, obj, key):
+    """Remove an object from the index for the given property, before the property changes
+    """
+    if key in obj.props:
+      matches = self.indexes[key].get(obj.props[key])
+      if matches is not None:
+        matches.discard(obj)
+        if not matches:
+          del self.indexes[key][obj.props[key]]
+
+
+  def reindex(self, obj, key):
+    """Add an object to the index for the given property, after the property changes
+    """
+    if key in obj.props:
+      self.indexes[key].setdefault(obj.props[key], set()).add(obj)
+
+
+  def withProp(self, key, value):
+    """Get the set of objects whose given property has the given value, either set on the object itself or inherited
+    from a template.  Indexes the bag by the property on first use.
+    """
+    result = set(self.indexBy(key).get(value, ()))
+    for template, users in self.users.iteritems():
+      if users and template.lookup(key) == value:
+        result.update([obj for obj in users if key not in obj.props])
+    return result
+
+
   def generate(self, out):
-    """Write config fragemts for this bag to the given output stream
+    """Write config fragemts for this bag to the given output stream, one definition at a time, in name order
     """
-    for item in sorted(self.bag.items()):
-      out.write('%s\n' % repr(item[1]))
+    writer = out if isinstance(out, ChunkedWriter) else ChunkedWriter(out)
+    bag = self.bag
+    for name in sorted(bag):
+      writer.write(bag[name].render())
+      writer.write('\n')
+    if writer is not out:
+      writer.flush()
 
 
 
@@ -98,21 +382,35 @@ class HostGroup(NagObj):
   """
   typeName = 'hostgroup'
 
+  __slots__ = ('members',)
+
 
   def __init__(self, name):
     NagObj.__init__(self, name)
-    self.members = []
+    self.members = set()
 
 
   def add(self, member):
     """Add a host to this group
     """
-    self.members.append(member)
-    
+    self.members.add(member)
 
-  def __repr__(self):
-    self.props['hostgroup_name'] = self.name
-    return NagObj.__repr__(self)
+
+  def addAll(self, hosts):
+    """Add many hosts to this group
+    """
+    hosts = list(hosts)
+    for host in hosts:
+      host.hostgroups.add(self)
+    self.members.update(hosts)
+
+
+  def derivedFields(self):
+    """The group name, plus the template if any
+    """
+    derived = NagObj.derivedFields(self) or {}
+    derived['hostgroup_name'] = self.name
+    return derived
 
 
 
@@ -135,6 +433,8 @@ class Host(NagObj):
 
   typeName = 'host'
 
+  __slots__ = ('hostgroups',)
+
 
   def __init__(self, name):
     NagObj.__init__(self, name)
@@ -149,10 +449,20 @@ class Host(NagObj):
     hg.add(self)
 
 
-  def __repr__(self):
-    self.props['host_name'] = self.name
-    self.props['hostgroups'] = ','.join(sorted([hg.name for hg in self.hostgroups]))
-    return NagObj.__repr__(self)
+  def addGroups(self, names):
+    """Mark this host as a member of each of the given groups, creating them if needed
+    """
+    for name in names:
+      self.addGroup(name)
+
+
+  def derivedFields(self):
+    """The host name and groups, plus the template if any
+    """
+    derived = NagObj.derivedFields(self) or {}
+    derived['host_name'] = self.name
+    derived['hostgroups'] = ','.join(sorted([hg.name for hg in self.hostgroups]))
+    return derived
 
 
 
@@ -164,6 +474,13 @@ class HostBag(NagBag):
     NagBag.__init__(self, Host)
 
 
+  def inGroup(self, name):
+    """Get the set of hosts in the given group
+    """
+    hg = HOSTGROUPS.get(name)
+    return set(hg.members) if hg else set()
+
+
 
 HOSTS = HostBag()
 
@@ -174,6 +491,8 @@ class Service(NagObj):
   """
   typeName = 'service'
 
+  __slots__ = ()
+
 
 
 class ServiceBag(NagBag):
@@ -184,12 +503,298 @@ class ServiceBag(NagBag):
     NagBag.__init__(self, Service)
 
 
+  def onHosts(self, hosts):
+    """Get the set of services on the given hosts, by their host_name
+    """
+    index = self.indexBy('host_name')
+    result = set()
+    for host in hosts:
+      result.update(index.get(host.name, ()))
+    return result
+
+
 SERVICES = ServiceBag()
 
 
+
+class Template(NagObj):
+  """Represent a nagios object template: a named set of properties that objects inherit with use
+  """
+
+  __slots__ = ()
+
+
+  def derivedFields(self):
+    """The template name and register 0, plus the parent template if any
+    """
+    derived = NagObj.derivedFields(self) or {}
+    derived['name'] = self.name
+    derived['register'] = '0'
+    return derived
+
+
+
+class HostTemplate(Template):
+  """Represent a nagios host template
+  """
+  typeName = 'host'
+
+  __slots__ = ()
+
+
+
+class ServiceTemplate(Template):
+  """Represent a nagios service template
+  """
+  typeName = 'service'
+
+  __slots__ = ()
+
+
+
+HOSTTEMPLATES = NagBag(HostTemplate)
+
+SERVICETEMPLATES = NagBag(ServiceTemplate)
+
+
+def extractTemplates(bag, templates, minObjects=10, minProps=2):
+  """Move the properties that many objects in bag have in common into shared templates in the templates bag.
+
+  Each object starts from the set of its properties that at least minObjects objects share.  Objects with the same
+  set inherit it from one template if there are at least minObjects of them; the others drop their least shared
+  property and try again, until fewer than minProps are left.  Templates are named after a hash of their contents,
+  so reruns produce the same names, and objects keep only the rest of their properties in props.  Objects that
+  already use a template are left alone.  Returns the templates that were used.
+  """
+  candidates = [obj for obj in bag.bag.itervalues() if obj.template is None]
+  counts = defaultdict(int)
+  for obj in candidates:
+    for item in obj.props.iteritems():
+      counts[item] += 1
+
+  byCount = lambda item: (-counts[item], item)
+  pending = [(obj, tuple(sorted([item for item in obj.props.iteritems() if counts[item] >= minObjects], key=byCount)))
+             for obj in candidates]
+  used = []
+  while pending:
+    groups = defaultdict(list)
+    for obj, common in pending:
+      if len(common) >= minProps:
+        groups[common].append(obj)
+
+    pending = []
+    for common, objs in groups.iteritems():
+      if len(objs) < minObjects:
+        pending.extend([(obj, common[:-1]) for obj in objs])
+        continue
+      items = sorted(common)
+      template = templates.getOrCreate('%s-%s' % (templates.klass.typeName, hashlib.sha1(repr(items)).hexdigest()[:12]))
+      template.props.update(items)
+      used.append(template)
+      keys = set([k for k, _ in items])
+      for obj in objs:
+        # Build a new dict, since dicts never shrink when keys are deleted.
+        obj.props = dict([(k, v) for k, v in obj.props.iteritems() if k not in keys])
+        obj.use(template)
+  return sorted(used, key=lambda template: template.name)
+
+
 def generate(out=sys.stdout):
-  """Print nagios configuration fragments to the given output stream
+  """Print nagios configuration fragments to the given output stream, in chunks as they are rendered
+  """
+  writer = ChunkedWriter(out)
+  HOSTTEMPLATES.generate(writer)
+  SERVICETEMPLATES.generate(writer)
+  HOSTGROUPS.generate(writer)
+  HOSTS.generate(writer)
+  SERVICES.generate(writer)
+  writer.flush()
+
+
+
+MANIFEST = 'manifest.json'
+
+
+def shardName(name):
+  """Turn an object name into a safe file name part
+  """
+  return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+def shards(byHostGroup=False):
+  """Split all objects into shards, returning a dict from shard file name to the objects in it, in output order.
+
+  Objects are sharded by type, or with byHostGroup, hosts are sharded by their first host group (in name order) and
+  services go to the shard of their host_name.
+  """
+  result = {}
+  for bag in (HOSTTEMPLATES, SERVICETEMPLATES):
+    for name in sorted(bag.bag):
+      result.setdefault('templates.cfg', []).append(bag.bag[name])
+
+  for name in sorted(HOSTGROUPS.bag):
+    result.setdefault('hostgroups.cfg', []).append(HOSTGROUPS.bag[name])
+
+  hostShards = {}
+  for name in sorted(HOSTS.bag):
+    host = HOSTS.bag[name]
+    shard = 'hosts.cfg'
+    if byHostGroup and host.hostgroups:
+      shard = 'hostgroup-%s.cfg' % shardName(min([hg.name for hg in host.hostgroups]))
+    hostShards[name] = shard
+    result.setdefault(shard, []).append(host)
+
+  for name in sorted(SERVICES.bag):
+    service = SERVICES.bag[name]
+    shard = 'services.cfg'
+    if byHostGroup:
+      shard = hostShards.get(service.props.get('host_name'), shard)
+    result.setdefault(shard, []).append(service)
+  return result
+
+
+def loadManifest(directory):
+  """Read the shard hashes written by the last generateShards run into directory
+  """
+  try:
+    with open(os.path.join(directory, MANIFEST)) as f:
+      return dict((str(filename), digest) for filename, digest in json.load(f).iteritems())
+  except (IOError, ValueError):
+    return {}
+
+
+def generateShards(directory, byHostGroup=False):
+  """Write nagios configuration to one file per shard in directory, rewriting only the shards whose contents changed
+  since the last run and removing shards that no longer exist.
+
+  Returns a dict with the sorted shard file names that were 'added', 'changed', 'removed' and 'unchanged'.
+  """
+  previous = loadManifest(directory)
+  manifest = {}
+  changes = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+
+  for filename, objects in sorted(shards(byHostGroup).iteritems()):
+    path = os.path.join(directory, filename)
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+      writer = HashingWriter(f)
+      for obj in objects:
+        writer.write(obj.render())
+        writer.write('\n')
+      writer.flush()
+    manifest[filename] = writer.hash.hexdigest()
+
+    if previous.get(filename) == manifest[filename] and os.path.exists(path):
+      os.remove(temp)
+      changes['unchanged'].append(filename)
+    else:
+      os.rename(temp, path)
+      changes['changed' if filename in previous else 'added'].append(filename)
+
+  for filename in sorted(set(previous) - set(manifest)):
+    path = os.path.join(directory, filename)
+    if os.path.exists(path):
+      os.remove(path)
+    changes['removed'].append(filename)
+
+  temp = os.path.join(directory, MANIFEST + '.tmp')
+  with open(temp, 'w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.rename(temp, os.path.join(directory, MANIFEST))
+  return changes
+
+
+
+class MergeConflict(Exception):
+  """Raised when partial bags define the same object differently
+  """
+
+
+
+# The global bags, in the order they are snapshotted and merged, each with the bag its objects' templates are in.
+BAGS = (
+  ('hosttemplates', HOSTTEMPLATES, HOSTTEMPLATES),
+  ('servicetemplates', SERVICETEMPLATES, SERVICETEMPLATES),
+  ('hostgroups', HOSTGROUPS, None),
+  ('hosts', HOSTS, HOSTTEMPLATES),
+  ('services', SERVICES, SERVICETEMPLATES),
+)
+
+
+def reset():
+  """Remove every object from the global bags
+  """
+  for _, bag, _ in BAGS:
+    bag.bag.clear()
+    bag.indexes.clear()
+    bag.users.clear()
+
+
+def snapshot():
+  """Get the contents of the global bags as plain data that can be pickled and passed to merge
+  """
+  result = {}
+  for key, bag, _ in BAGS:
+    objects = result[key] = {}
+    for name, obj in bag.bag.iteritems():
+      groups = sorted([hg.name for hg in obj.hostgroups]) if isinstance(obj, Host) else []
+      objects[name] = (dict(obj.props), obj.meta, obj.template.name if obj.template else None, groups)
+  return result
+
+
+def merge(partial):
+  """Merge a snapshot of partial bags into the global bags.  Properties and meta data of objects defined in more
+  than one partial bag are combined, and host group memberships are unioned.  Raises MergeConflict if the same
+  property, meta data key or template is defined differently.
+  """
+  for key, bag, templates in BAGS:
+    for name, (props, meta, template, groups) in partial[key].iteritems():
+      obj = bag.bag.get(name)
+      if obj is None:
+        obj = bag.create(name)
+        obj.props.update(props)
+        obj.meta.update(meta)
+      else:
+        mergeDict(obj.props, props, 'property', bag.klass.typeName, name)
+        mergeDict(obj.meta, meta, 'meta data', bag.klass.typeName, name)
+      if template is not None:
+        assert templates is not None
+        if obj.template is not None and obj.template.name != template:
+          raise MergeConflict('%s %s uses both %s and %s' % (bag.klass.typeName, name, obj.template.name, template))
+        obj.use(templates.getOrCreate(template))
+      if groups:
+        obj.addGroups(groups)
+
+
+def mergeDict(target, source, kind, typeName, name):
+  """Copy source into target, raising MergeConflict if a key is already set to a different value
+  """
+  for k, v in source.iteritems():
+    if k in target and target[k] != v:
+      raise MergeConflict('%s %s has %s %s set to both %r and %r' % (typeName, name, kind, k, target[k], v))
+    target[k] = v
+
+
+def buildSlice(args):
+  """Worker process entry point: build one slice of the inventory into empty global bags and snapshot them
+  """
+  build, inventorySlice = args
+  reset()
+  build(inventorySlice)
+  return snapshot()
+
+
+def buildParallel(build, slices, processes=None):
+  """Call build(slice) for each slice in a pool of worker processes and merge the partial bags they build into the
+  global bags.  build must be a module level function that adds objects to the global bags.
+
+  Generated output is the same as calling build for each slice in one process, since merging is insensitive to
+  order and generate sorts everything.  Run extractTemplates after merging, on the whole fleet.
   """
-  HOSTGROUPS.generate(out)
-  HOSTS.generate(out)
-  SERVICES.generate(out)
+  pool = multiprocessing.Pool(processes)
+  try:
+    partials = pool.map(buildSlice, [(build, inventorySlice) for inventorySlice in slices], chunksize=1)
+  finally:
+    pool.terminate()
+  for partial in partials:
+    merge(partial)